@@ -191,6 +191,79 @@ var game = (function(){
         return null;
     }
 
+    // 差分フレーム (frame, base) を base のフレームに適用する
+    var applyDelta = function(base, delta) {
+        var schedule = {};
+        for (var i = 0; i < base.schedule.length; i++) {
+            schedule[base.schedule[i].time] = base.schedule[i];
+        }
+        for (var i = 0; i < delta.schedule_removed.length; i++) {
+            delete schedule[delta.schedule_removed[i]];
+        }
+        for (var i = 0; i < delta.schedule.length; i++) {
+            schedule[delta.schedule[i].time] = delta.schedule[i];
+        }
+        var times = Object.keys(schedule).map(Number);
+        times.sort(function(a,b){ return a - b; });
+
+        var items = {};
+        for (var i = 0; i < delta.items.length; i++) {
+            items[delta.items[i].item_id] = delta.items[i];
+        }
+        var merged_items = [];
+        for (var i = 0; i < base.items.length; i++) {
+            var item_id = base.items[i].item_id;
+            merged_items.push(item_id in items ? items[item_id] : base.items[i]);
+            delete items[item_id];
+        }
+        for (var item_id in items) merged_items.push(items[item_id]);
+
+        var on_sale = {};
+        for (var i = 0; i < base.on_sale.length; i++) {
+            on_sale[base.on_sale[i].item_id] = base.on_sale[i];
+        }
+        for (var i = 0; i < delta.on_sale_removed.length; i++) {
+            delete on_sale[delta.on_sale_removed[i]];
+        }
+        for (var i = 0; i < delta.on_sale.length; i++) {
+            on_sale[delta.on_sale[i].item_id] = delta.on_sale[i];
+        }
+
+        return {
+            "frame": delta.frame,
+            "time": delta.time,
+            "adding": delta.adding,
+            "schedule": times.map(function(t){ return schedule[t]; }),
+            "items": merged_items,
+            "on_sale": Object.keys(on_sale).map(function(k){ return on_sale[k]; }),
+        };
+    }
+
+    // format=compact のフレームの要素 (キーを除いた配列) を通常の形に戻す
+    var decodeCompact = function(res) {
+        var data = {};
+        for (var k in res) data[k] = res[k];
+        data.adding = res.adding.map(function(a) {
+            return {"time": a[0], "isu": a[1]};
+        });
+        data.schedule = res.schedule.map(function(s) {
+            return {"time": s[0], "milli_isu": [s[1], s[2]], "total_power": [s[3], s[4]]};
+        });
+        data.items = res.items.map(function(i) {
+            return {
+                "item_id": i[0], "count_bought": i[1], "count_built": i[2],
+                "next_price": [i[3], i[4]], "power": [i[5], i[6]],
+                "building": i[7].map(function(b) {
+                    return {"time": b[0], "count_built": b[1], "power": [b[2], b[3]]};
+                }),
+            };
+        });
+        data.on_sale = res.on_sale.map(function(o) {
+            return {"item_id": o[0], "time": o[1]};
+        });
+        return data;
+    }
+
     var Room = function(name) {
         this.name = name;
         this.conn = null;
@@ -203,6 +276,9 @@ var game = (function(){
         this.sending = {};
         this.buying = false;
         this.addValue = [0, 0];
+        this.frames = {};
+        this.acked = [];  // {frame, callback}. 番号 frame 以降のフレームを受け取ってから呼ぶ成功応答
+        this.lastFrame = null;  // 受け取った最新のフレームの番号
     }
     Room.prototype.connect = function(uri) {
         var self = this;
@@ -216,10 +292,19 @@ var game = (function(){
                 var res = JSON.parse(msg.data);
                 console.log(res);
                 if (res.request_id) {
-                    self.callbacks[res.request_id](res);
+                    // 応答は status の計算し直しを待たずに届くので, 成功したものは
+                    // それを反映したフレーム (番号 res.frame 以降) を受け取るまで送信中の表示を残す
+                    var callback = self.callbacks[res.request_id];
                     self.callbacks[res.request_id] = null;
+                    if (res.is_success && res.frame != null && !(self.lastFrame >= res.frame)) {
+                        self.acked.push({"frame": res.frame, "callback": function() { callback(res); }});
+                    } else {
+                        callback(res);
+                    }
+                } else if ("frame" in res) {
+                    self.receiveFrame(decodeCompact(res));
                 } else {
-                    self.receiveData(res);
+                    self.receiveData(decodeCompact(res));
                 }
             }
         }
@@ -246,6 +331,39 @@ var game = (function(){
             this.gameState = new GameState(this.name, data);
         }
     }
+    Room.prototype.receiveFrame = function(res) {
+        var data = res;
+        if ("base" in res) {
+            if (!(res.base in this.frames)) {
+                // 元のフレームを持っていないのでキーフレームを送ってもらう
+                this.conn.send(JSON.stringify({"action": "ackFrame", "frame": -1}));
+                return;
+            }
+            data = applyDelta(this.frames[res.base], res);
+            for (var id in this.frames) {
+                if (Number(id) < res.base) delete this.frames[id];
+            }
+        } else {
+            this.frames = {};
+        }
+        this.frames[res.frame] = data;
+        this.conn.send(JSON.stringify({"action": "ackFrame", "frame": res.frame}));
+        this.receiveData(data);
+        this.releaseAcked(res.frame);
+    }
+    Room.prototype.releaseAcked = function(frame) {
+        if (this.lastFrame == null || frame > this.lastFrame) this.lastFrame = frame;
+        var waiting = [];
+        for (var i = 0; i < this.acked.length; i++) {
+            var a = this.acked[i];
+            if (a.frame <= frame) {
+                a.callback();
+            } else {
+                waiting.push(a);
+            }
+        }
+        this.acked = waiting;
+    }
     Room.prototype.sendRequest = function(req, callback) {
         var self = this;
         if (!self.isOpen) {
@@ -335,7 +453,7 @@ var game = (function(){
                     if (host === "") {
                         host = location.host;
                     }
-                    var addr = "ws://" + host + this.response.path;
+                    var addr = "ws://" + host + this.response.path + "?delta=1&format=compact";
                     room = new Room(name);
                     room.connect(addr);
                 }
@@ -1,43 +1,78 @@
 #!/usr/bin/env python3
 
 import asyncio
+import logging
+import os
 from pathlib import Path
 import urllib.parse
 
+import aiohttp
 from aiohttp import web
 
 import game
+from hashring import HashRing
 
 
 public_dir = (Path(__file__) / '../../public').resolve()
 
+# 部屋ごとに担当するホストを固定して, 同じ部屋の接続が同じプロセスの
+# メモリ上の状態を共有するようにする. 未設定ならどのホストでも受ける.
+web_hosts = HashRing([h for h in os.environ.get("ISU_WEB_HOSTS", "").split(",") if h])
+
 
 async def initialize_handler(request):
+    # 部屋の状態は担当するホストのメモリ上にあるので, テーブルを空にしたら
+    # 他のホストにも ?local=1 で知らせて捨てさせる
+    if request.query.get("local") == "1":
+        game.clear_local_state()
+        return web.HTTPNoContent()
+
     game.initialize()
+    if len(web_hosts):
+        async with aiohttp.ClientSession() as session:
+            results = await asyncio.gather(
+                *[asyncio.wait_for(notify_initialize(session, host), 5) for host in web_hosts.hosts],
+                return_exceptions=True)
+        for host, result in zip(web_hosts.hosts, results):
+            if isinstance(result, Exception):
+                logging.error("fail to initialize %s: %r", host, result)
     return web.HTTPNoContent()
 
 
+async def notify_initialize(session: aiohttp.ClientSession, host: str):
+    async with session.get(f"http://{host}/initialize", params={"local": "1"}) as res:
+        res.raise_for_status()
+
+
+async def stats_handler(request):
+    return web.json_response(game.get_stats())
+
+
 async def index_handler(request):
     return web.FileResponse(public_dir / 'index.html')
 
 
 async def room_handler(request):
     room_name = request.match_info.get('room_name', '')
-    res = {"host": "", "path": "/ws/" + urllib.parse.quote(room_name)}
+    host = web_hosts.get(room_name) if len(web_hosts) else ""
+    res = {"host": host, "path": "/ws/" + urllib.parse.quote(room_name)}
     return web.json_response(res)
 
 
 async def game_handler(request):
     room_name = request.match_info.get("room_name", "")
+    delta = request.query.get("delta") == "1"
+    format = request.query.get("format", "json")
     ws = web.WebSocketResponse()
     await ws.prepare(request)
-    await game.serve(ws, room_name)
+    await game.serve(ws, room_name, delta, format)
     return ws
 
 
 def main():
     app = web.Application()
     app.router.add_get("/initialize", initialize_handler)
+    app.router.add_get("/stats", stats_handler)
     app.router.add_get("/room/{room_name}", room_handler)
     app.router.add_get("/room/", room_handler)
     app.router.add_get("/ws/{room_name}", game_handler)
@@ -48,6 +83,7 @@ def main():
 
 app = web.Application()
 app.router.add_get("/initialize", initialize_handler)
+app.router.add_get("/stats", stats_handler)
 app.router.add_get("/room/{room_name}", room_handler)
 app.router.add_get("/room/", room_handler)
 app.router.add_get("/ws/{room_name}", game_handler)
@@ -55,6 +91,9 @@ app.router.add_get("/ws/", game_handler)
 app.router.add_get('/', index_handler)
 app.router.add_static('/', path=public_dir, name="static")
 
+# 計算用の子プロセスはイベントループやスレッドプールより先に fork する
+game.start_calc_pool()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""ベンチマーク
+
+    python bench.py encode [--sizes 10,100,1000] [--repeat 20]
+    python bench.py onsale [--items 13] [--repeat 20]
+    python bench.py history [--sizes 1000,10000] [--repeat 5]
+    python bench.py calc [--sizes 10,100,1000] [--repeat 20]
+    python bench.py int2exp [--digits 10,100,1000] [--repeat 20]
+    python bench.py item [--counts 1,10,100,1000] [--repeat 20]
+    python bench.py load [--rooms 4] [--clients 4] [--duration 10] [--url http://host:port]
+
+MySQL の代わりに fakedb を使うので, MySQL がなくても実行できる.
+部屋のデータは fakedb.make_items のアイテムマスタから作る.
+load は --url を指定しなければ fakedb で app.py を子プロセスとして起動し,
+部屋ごとに複数の WebSocket クライアントから addIsu, buyItem を送る.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import resource
+import signal
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+import simplejson
+
+import fakedb
+from fakedb import make_items as bench_items
+
+# game を import する前に MySQL をメモリ上の表に差し替える
+fakedb.install()
+
+from game import calc_status, calc_status_history, calc_item_power, calc_item_price, \
+    get_item_price, get_item_power, int2exp, Adding, Buying, Checkpoint, RoomHistory
+from wire import encode_status, StatusFrame, COMPACT, decode_compact
+
+
+def make_room(mitems: dict, num_buyings: int, current_time: int = 10000, seed: int = 0) -> (list, list):
+    """num_buyings 回購入した部屋. 半分は current_time 以降に建つ"""
+    rand = random.Random(seed)
+    addings = [Adding(0, str(10 ** 200))]
+    bought = {item_id: 0 for item_id in mitems}
+    buyings = []
+    for n in range(num_buyings):
+        item_id = rand.choice(list(mitems))
+        bought[item_id] += 1
+        if n < num_buyings // 2:
+            t = rand.randrange(0, current_time)
+        else:
+            t = rand.randrange(current_time + 1, current_time + 1000)
+        buyings.append(Buying(item_id, bought[item_id], t))
+    for t in range(current_time + 1, current_time + 1000, 50):
+        addings.append(Adding(t, str(rand.randrange(10 ** 20))))
+    return addings, buyings
+
+
+def timeit(f, repeat: int) -> float:
+    """f を repeat 回呼んだときの1回あたりの秒数 (最小値)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_encode(sizes: list, repeat: int):
+    mitems = bench_items()
+    print(f"{'buyings':>8} {'bytes':>10} {'compact':>10} {'simplejson':>12} {'encode_status':>14} {'compact':>10}")
+    for size in sizes:
+        addings, buyings = make_room(mitems, size)
+        status = calc_status(10000, mitems, addings, buyings)
+        t_simplejson = timeit(lambda: simplejson.dumps(status), repeat)
+        t_encode = timeit(lambda: encode_status(status), repeat)
+        t_compact = timeit(lambda: StatusFrame(1, status).full(COMPACT), repeat)
+        print(f"{size:>8} {len(encode_status(status)):>10} {len(StatusFrame(1, status).full(COMPACT)):>10} "
+              f"{t_simplejson*1000:>10.3f}ms {t_encode*1000:>12.3f}ms {t_compact*1000:>8.3f}ms")
+
+
+def on_sale_bisect(milli_isu: int, power: int, targets: list, t: int, nt: int) -> list:
+    """以前の calc_status と同じ二分探索で購入可能になる時刻を求める"""
+    result = []
+    for target in targets:
+        if milli_isu + (nt-1 - t) * power >= target:
+            l, r = t-1, nt-1
+            while r - l > 1:
+                mid = (l+r)//2
+                if milli_isu + (mid - t) * power >= target:
+                    r = mid
+                else:
+                    l = mid
+            result.append(r)
+    return result
+
+
+def on_sale_division(milli_isu: int, power: int, targets: list, t: int, nt: int) -> list:
+    """calc_status と同じ割り算で購入可能になる時刻を求める (targets は昇順)"""
+    result = []
+    for target in targets:
+        if milli_isu + (nt-1 - t) * power < target:
+            break
+        need = target - milli_isu
+        result.append(t if need <= 0 else t + (need + power - 1) // power)
+    return result
+
+
+def bench_on_sale(num_items: int, repeat: int):
+    mitems = bench_items(num_items)
+    print(f"{'count':>6} {'power digits':>13} {'bisect':>10} {'division':>10}")
+    for count in [1, 10, 50, 200]:
+        power = sum(calc_item_power(m, count) for m in mitems.values())
+        targets = sorted(calc_item_price(m, count + 1) * 1000 for m in mitems.values())
+        # 1秒の先読み中に半分くらいのアイテムが買えるようになる残高にする
+        milli_isu = targets[len(targets) // 2] - power * 500
+        assert on_sale_bisect(milli_isu, power, targets, 0, 1001) == \
+            on_sale_division(milli_isu, power, targets, 0, 1001)
+        t_bisect = timeit(lambda: on_sale_bisect(milli_isu, power, targets, 0, 1001), repeat)
+        t_division = timeit(lambda: on_sale_division(milli_isu, power, targets, 0, 1001), repeat)
+        print(f"{count:>6} {len(str(power)):>13} {t_bisect*1000:>8.3f}ms {t_division*1000:>8.3f}ms")
+
+
+def traced(f) -> (object, int, int):
+    """f() の戻り値と, 実行中に確保したメモリのピークと, 終了時に残ったメモリ"""
+    tracemalloc.start()
+    try:
+        result = f()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak, current
+
+
+def bench_history(sizes: list, repeat: int):
+    mitems = bench_items()
+    print(f"{'events':>7} {'':>12} {'storage':>10} {'frame peak':>11} {'frame time':>11}")
+    for size in sizes:
+        addings, buyings = make_room(mitems, size // 2)
+        addings = [Adding(t, int(isu)) for t, isu in addings]
+        addings += [Adding(t, 1) for t in range(1, size // 2 - len(addings) + 1)]
+
+        lists, lists_size, _ = traced(lambda: ([Adding(t, i) for t, i in addings], [Buying(*b) for b in buyings]))
+        history, history_size, _ = traced(lambda: RoomHistory.from_lists(addings, buyings))
+
+        # ItemTable を先に埋めておく
+        calc_status(10000, mitems, *lists)
+        _, lists_peak, _ = traced(lambda: calc_status(10000, mitems, *lists))
+        _, history_peak, _ = traced(lambda: calc_status_history(10000, mitems, Checkpoint(), history))
+        t_lists = timeit(lambda: calc_status(10000, mitems, *lists), repeat)
+        t_history = timeit(lambda: calc_status_history(10000, mitems, Checkpoint(), history), repeat)
+
+        print(f"{size:>7} {'namedtuple':>12} {lists_size/1024:>8.1f}KB {lists_peak/1024:>9.1f}KB {t_lists*1000:>9.3f}ms")
+        print(f"{'':>7} {'RoomHistory':>12} {history_size/1024:>8.1f}KB {history_peak/1024:>9.1f}KB {t_history*1000:>9.3f}ms")
+
+
+def bench_calc(sizes: list, repeat: int):
+    mitems = bench_items()
+    print(f"{'buyings':>8} {'calc_status':>12}")
+    for size in sizes:
+        addings, buyings = make_room(mitems, size)
+        calc_status(10000, mitems, addings, buyings)  # ItemTable を先に埋めておく
+        t = timeit(lambda: calc_status(10000, mitems, addings, buyings), repeat)
+        print(f"{size:>8} {t*1000:>10.3f}ms")
+
+
+def bench_int2exp(digits: list, repeat: int):
+    print(f"{'digits':>7} {'int2exp':>10}")
+    for d in digits:
+        xs = [random.randrange(10 ** (d - 1), 10 ** d) for _ in range(100)]
+        t = timeit(lambda: [int2exp(x) for x in xs], repeat) / len(xs)
+        print(f"{d:>7} {t*1000000:>8.2f}us")
+
+
+def bench_item(counts: list, repeat: int):
+    """毎回計算する calc_item_* と, ItemTable に覚えておく get_item_* の比較"""
+    mitems = bench_items()
+    print(f"{'count':>6} {'calc_item_price':>16} {'get_item_price':>15} {'calc_item_power':>16} {'get_item_power':>15}")
+    for count in counts:
+        ms = list(mitems.values())
+        for m in ms:
+            get_item_price(m, count)
+            get_item_power(m, count)
+        times = [timeit(lambda: [f(m, count) for m in ms], repeat) / len(ms)
+                 for f in (calc_item_price, get_item_price, calc_item_power, get_item_power)]
+        print(f"{count:>6} " + " ".join(f"{t*1000000:>14.2f}us" for t in times))
+
+
+def percentiles(xs: list) -> str:
+    if not xs:
+        return "-"
+    xs = sorted(xs)
+    def p(q):
+        return xs[min(len(xs) - 1, int(len(xs) * q))]
+    return f"p50={p(0.5):.1f} p90={p(0.9):.1f} p99={p(0.99):.1f} max={xs[-1]:.1f}"
+
+
+class LoadResult:
+
+    def __init__(self):
+        self.frame_latency = []  # status の time を受け取るまでのミリ秒
+        self.sent = {"addIsu": 0, "buyItem": 0}
+        self.success = {"addIsu": 0, "buyItem": 0}
+        self.latency = {"addIsu": [], "buyItem": []}  # 応答までのミリ秒
+        self.frame_bytes = 0
+
+
+async def load_client(session: 'aiohttp.ClientSession', url: str, duration: float, interval: float,
+                      buy_rate: float, result: LoadResult, rand: random.Random, compact: bool = False):
+    """1つの WebSocket クライアント
+
+    平均 interval 秒ごとに少し先の時刻に addIsu を送り, 受け取った status で
+    今買えるアイテムがあれば buy_rate の確率で buyItem を送る.
+    """
+    ws = await session.ws_connect(url + ("?format=compact" if compact else ""))
+    last = None  # (status, 受け取った time.monotonic())
+    pending = {}  # request_id: (action, 送った time.perf_counter())
+    next_id = 0
+    end = time.monotonic() + duration
+
+    async def send(action: str, **kwargs):
+        nonlocal next_id
+        next_id += 1
+        pending[next_id] = (action, time.perf_counter())
+        result.sent[action] += 1
+        await ws.send_str(simplejson.dumps(dict(request_id=next_id, action=action, **kwargs)))
+
+    async def sender():
+        while time.monotonic() < end:
+            await asyncio.sleep(rand.expovariate(1 / interval))
+            if last is None or ws.closed:
+                continue
+            status, at = last
+            t = status["time"] + int((time.monotonic() - at) * 1000) + 100
+            await send("addIsu", time=t, isu=str(rand.randrange(1, 10 ** rand.randrange(1, 30))))
+            if rand.random() < buy_rate:
+                bought = {item["item_id"]: item["count_bought"] for item in status["items"]}
+                on_sale = [s["item_id"] for s in status["on_sale"] if s["time"] <= t]
+                if on_sale:
+                    item_id = rand.choice(on_sale)
+                    await send("buyItem", time=t, item_id=item_id, count_bought=bought[item_id])
+
+    task = asyncio.ensure_future(sender())
+    try:
+        while time.monotonic() < end:
+            try:
+                msg = await asyncio.wait_for(ws.receive(), end - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            data = simplejson.loads(msg.data)
+            if "request_id" in data:
+                action, sent_at = pending.pop(data["request_id"])
+                result.latency[action].append((time.perf_counter() - sent_at) * 1000)
+                if data["is_success"]:
+                    result.success[action] += 1
+            else:
+                result.frame_latency.append(time.time() * 1000 - data["time"])
+                result.frame_bytes += len(msg.data)
+                if compact:
+                    data = decode_compact(data)
+                last = (data, time.monotonic())
+    finally:
+        task.cancel()
+        await ws.close()
+
+
+async def wait_server(session: 'aiohttp.ClientSession', base: str, timeout: float = 10.0):
+    end = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(base + "/stats") as res:
+                if res.status == 200:
+                    return
+        except aiohttp.ClientError:
+            if time.monotonic() > end:
+                raise
+        await asyncio.sleep(0.1)
+
+
+async def run_load(base: str, rooms: int, clients: int, duration: float, interval: float,
+                   buy_rate: float, seed: int, compact: bool) -> (LoadResult, dict):
+    result = LoadResult()
+    rand = random.Random(seed)
+    async with aiohttp.ClientSession() as session:
+        await wait_server(session, base)
+        async with session.get(base + "/initialize") as res:
+            assert res.status < 300
+        ws_base = "ws" + base[len("http"):]
+        await asyncio.gather(*[
+            load_client(session, f"{ws_base}/ws/bench{r}", duration, interval, buy_rate,
+                        result, random.Random(rand.random()), compact)
+            for r in range(rooms) for _ in range(clients)])
+        async with session.get(base + "/stats") as res:
+            server_stats = await res.json()
+    return result, server_stats
+
+
+def bench_load(url: str, port: int, latency: float, rooms: int, clients: int, duration: float,
+               interval: float, buy_rate: float, seed: int, compact: bool):
+    server = None
+    if url is None:
+        url = f"http://127.0.0.1:{port}"
+        server = subprocess.Popen(
+            [sys.executable, "fakedb.py", "--port", str(port), "--latency", str(latency)],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        loop = asyncio.get_event_loop()
+        result, server_stats = loop.run_until_complete(
+            run_load(url, rooms, clients, duration, interval, buy_rate, seed, compact))
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+
+    frames = len(result.frame_latency)
+    print(f"rooms={rooms} clients/room={clients} duration={duration}s")
+    print(f"status frames: {frames} ({frames / duration:.1f}/s)")
+    print(f"  latency ms: {percentiles(result.frame_latency)}")
+    print(f"  bytes/frame: {result.frame_bytes / max(frames, 1):.0f}")
+    for action in ("addIsu", "buyItem"):
+        sent, success = result.sent[action], result.success[action]
+        rate = success / sent * 100 if sent else 0.0
+        print(f"{action}: {success}/{sent} succeeded ({rate:.1f}%)")
+        print(f"  latency ms: {percentiles(result.latency[action])}")
+    if server is not None:
+        # 子プロセスの CPU 時間は終了した後にしか取れない
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = usage.ru_utime + usage.ru_stime
+        print(f"server cpu: {cpu:.2f}s ({cpu / max(frames, 1) * 1000:.3f}ms/frame)")
+    if "push" in server_stats:
+        print(f"server push: {server_stats['push']['total']}")
+    if "status_cache" in server_stats:
+        print(f"server status cache: {server_stats['status_cache']}")
+    for action, s in server_stats.get("round_trips", {}).items():
+        print(f"  server {action} round trips: count={s['count']} mean={s['mean']:.2f} max={s['max']}")
+    for action, stages in sorted(server_stats["stages"].items()):
+        for stage, s in sorted(stages.items()):
+            print(f"  server {action}.{stage}: count={s['count']} p50={s['p50_ms']:.3f}ms p99={s['p99_ms']:.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("encode", help="status のエンコード時間")
+    p.add_argument("--sizes", default="10,100,1000,5000")
+    p.add_argument("--repeat", type=int, default=20)
+
+    p = sub.add_parser("onsale", help="購入可能時刻の計算時間")
+    p.add_argument("--items", type=int, default=13)
+    p.add_argument("--repeat", type=int, default=20)
+
+    p = sub.add_parser("history", help="イベント列の持ち方によるメモリと計算時間")
+    p.add_argument("--sizes", default="1000,10000,50000")
+    p.add_argument("--repeat", type=int, default=5)
+
+    p = sub.add_parser("calc", help="calc_status の計算時間")
+    p.add_argument("--sizes", default="10,100,1000,5000")
+    p.add_argument("--repeat", type=int, default=20)
+
+    p = sub.add_parser("int2exp", help="int2exp の1回あたりの時間")
+    p.add_argument("--digits", default="10,100,1000,10000")
+    p.add_argument("--repeat", type=int, default=20)
+
+    p = sub.add_parser("item", help="アイテムの価格と生産力の計算時間")
+    p.add_argument("--counts", default="1,10,100,1000")
+    p.add_argument("--repeat", type=int, default=20)
+
+    p = sub.add_parser("load", help="部屋ごとに複数の WebSocket クライアントで負荷をかける")
+    p.add_argument("--url", help="測るサーバー (例: http://127.0.0.1:5000). 省略すると fakedb で起動する")
+    p.add_argument("--port", type=int, default=5999)
+    p.add_argument("--latency", type=float, default=0.2, help="fakedb のクエリごとの待ち時間 (ミリ秒)")
+    p.add_argument("--rooms", type=int, default=4)
+    p.add_argument("--clients", type=int, default=4, help="部屋ごとのクライアント数")
+    p.add_argument("--duration", type=float, default=10.0)
+    p.add_argument("--interval", type=float, default=0.1, help="クライアントごとの addIsu の平均間隔 (秒)")
+    p.add_argument("--buy-rate", type=float, default=0.3, help="addIsu のついでに buyItem を送る確率")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--compact", action="store_true", help="status を format=compact で受け取る")
+
+    args = parser.parse_args()
+    if args.command == "encode":
+        bench_encode([int(x) for x in args.sizes.split(",")], args.repeat)
+    elif args.command == "onsale":
+        bench_on_sale(args.items, args.repeat)
+    elif args.command == "history":
+        bench_history([int(x) for x in args.sizes.split(",")], args.repeat)
+    elif args.command == "calc":
+        bench_calc([int(x) for x in args.sizes.split(",")], args.repeat)
+    elif args.command == "int2exp":
+        bench_int2exp([int(x) for x in args.digits.split(",")], args.repeat)
+    elif args.command == "item":
+        bench_item([int(x) for x in args.counts.split(",")], args.repeat)
+    elif args.command == "load":
+        bench_load(args.url, args.port, args.latency, args.rooms, args.clients, args.duration,
+                   args.interval, args.buy_rate, args.seed, args.compact)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""ゲームのクエリをまとめて少ない往復で発行する
+
+1つの操作で投げる文は Batch にためておき, ";" でつないで1回の往復で送る.
+そのためコネクションは CLIENT.MULTI_STATEMENTS をつけて作ること.
+COMMIT も最後の文として同じ往復に載せられる. 途中の文が失敗すると MySQL は
+残りの文を実行しないので, 例外を受け取ったら rollback すればよい.
+
+カーソルはタプルを返す通常のカーソルだけを使う. Session が操作ごとに
+往復の回数を数え, snapshot() で action ごとに集計を返す.
+"""
+
+import threading
+
+from MySQLdb.constants import CLIENT
+
+
+CLIENT_FLAG = CLIENT.MULTI_STATEMENTS
+
+# current_timestamp は文の開始時刻なので, ロックを待った後の時刻が欲しいときは sysdate を使う
+CURRENT_TIME_SQL = "SELECT floor(unix_timestamp(current_timestamp(3))*1000)"
+
+M_ITEM_COLUMNS = ("item_id", "power1", "power2", "power3", "power4", "price1", "price2", "price3", "price4")
+
+# 元のスキーマにない表. 起動時と /initialize で作る
+CREATE_ROOM_SNAPSHOT_SQL = """
+CREATE TABLE IF NOT EXISTS room_snapshot (
+  room_name VARCHAR(191) NOT NULL PRIMARY KEY,
+  time BIGINT NOT NULL,
+  milli_isu TEXT NOT NULL,
+  total_power TEXT NOT NULL,
+  items TEXT NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+"""
+
+# room_snapshot に畳み込んでいない行だけを読むための条件
+AFTER_SNAPSHOT = "time > IFNULL((SELECT time FROM room_snapshot WHERE room_name = %s), 0)"
+
+
+class Batch:
+    """1回の往復で送る文の列"""
+
+    def __init__(self):
+        self.statements = []
+        self.args = []
+        self.commits = False
+
+    def add(self, sql: str, args=()) -> int:
+        """文を足し, その結果が run の戻り値の何番目に入るかを返す"""
+        self.statements.append(sql)
+        self.args.extend(args)
+        return len(self.statements) - 1
+
+    def commit(self):
+        self.add("COMMIT")
+        self.commits = True
+
+    def query(self) -> (str, list):
+        return ";\n".join(self.statements), self.args
+
+
+class Session:
+    """1回の操作の間コネクションを包み, 往復の回数を数える
+
+    with を抜けたときに action ごとの集計に入れる. in_transaction は
+    トランザクションが続いているか (返却時に rollback が必要か).
+    """
+
+    def __init__(self, conn, action: str):
+        self.conn = conn
+        self.action = action
+        self.trips = 0
+        self.in_transaction = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        record(self.action, self.trips)
+
+    def run(self, batch: Batch) -> list:
+        """batch を1回の往復で実行し, 文ごとの行のリストを返す"""
+        self.trips += 1
+        self.in_transaction = True
+        cur = self.conn.cursor()
+        try:
+            cur.execute(*batch.query())
+            results = [cur.fetchall()]
+            while cur.nextset():
+                results.append(cur.fetchall())
+        finally:
+            cur.close()
+        self.in_transaction = not batch.commits
+        return results
+
+    async def run_async(self, batch: Batch) -> list:
+        """run の aiomysql 版"""
+        self.trips += 1
+        self.in_transaction = True
+        cur = await self.conn.cursor()
+        try:
+            await cur.execute(*batch.query())
+            results = [await cur.fetchall()]
+            while await cur.nextset():
+                results.append(await cur.fetchall())
+        finally:
+            await cur.close()
+        self.in_transaction = not batch.commits
+        return results
+
+    def rollback(self):
+        self.trips += 1
+        self.conn.rollback()
+        self.in_transaction = False
+
+    async def rollback_async(self):
+        self.trips += 1
+        await self.conn.rollback()
+        self.in_transaction = False
+
+
+_totals = {}  # action: [操作の回数, 往復の合計, 最大]
+_totals_lock = threading.Lock()
+
+
+def record(action: str, trips: int):
+    with _totals_lock:
+        total = _totals.setdefault(action, [0, 0, 0])
+        total[0] += 1
+        total[1] += trips
+        total[2] = max(total[2], trips)
+
+
+def snapshot() -> dict:
+    """{action: {count, trips, mean, max}} を返す"""
+    with _totals_lock:
+        return {
+            action: {"count": count, "trips": trips, "mean": trips / count, "max": max_trips}
+            for action, (count, trips, max_trips) in sorted(_totals.items())
+        }
+
+
+def reset():
+    with _totals_lock:
+        _totals.clear()
+
+
+def create_tables(batch: Batch) -> int:
+    return batch.add(CREATE_ROOM_SNAPSHOT_SQL)
+
+
+def select_m_items(batch: Batch) -> int:
+    return batch.add("SELECT " + ", ".join(M_ITEM_COLUMNS) + " FROM m_item")
+
+
+def lock_room(batch: Batch, room_name: str) -> int:
+    """部屋のロックを取り (room_time, MySQL の現在時刻) の行を読む
+
+    See page 13 and 17 in https://www.slideshare.net/ichirin2501/insert-51938787
+    """
+    batch.add("INSERT INTO room_time(room_name, time) VALUES (%s, 0) ON DUPLICATE KEY UPDATE time = time",
+              (room_name, ))
+    return batch.add("SELECT time, floor(unix_timestamp(sysdate(3))*1000) FROM room_time WHERE room_name = %s FOR UPDATE",
+                     (room_name, ))
+
+
+def update_room_time(batch: Batch, room_name: str, t: int) -> int:
+    return batch.add("UPDATE room_time SET time = %s WHERE room_name = %s", (t, room_name))
+
+
+def select_adding_rows(batch: Batch, room_name: str, times: list) -> int:
+    """times の adding の行 (time, isu) を読む. 部屋のロックを取った後に呼ぶ"""
+    return batch.add("SELECT time, isu FROM adding WHERE room_name = %s AND time IN (" +
+                     ",".join(["%s"] * len(times)) + ") FOR UPDATE",
+                     [room_name] + list(times))
+
+
+def upsert_adding_rows(batch: Batch, room_name: str, rows: list) -> int:
+    """rows は (time, isu). isu はその時刻の合計で, 今の値を置き換える"""
+    return batch.add("INSERT INTO adding(room_name, time, isu) VALUES " +
+                     ",".join(["(%s, %s, %s)"] * len(rows)) +
+                     " ON DUPLICATE KEY UPDATE isu=VALUES(isu)",
+                     [x for t, isu in rows for x in (room_name, t, str(isu))])
+
+
+def insert_buying(batch: Batch, room_name: str, item_id: int, ordinal: int, t: int) -> int:
+    return batch.add("INSERT INTO buying(room_name, item_id, ordinal, time) VALUES(%s, %s, %s, %s)",
+                     (room_name, item_id, ordinal, t))
+
+
+def select_snapshot(batch: Batch, room_name: str) -> int:
+    return batch.add("SELECT time, milli_isu, total_power, items FROM room_snapshot WHERE room_name = %s",
+                     (room_name, ))
+
+
+def save_snapshot(batch: Batch, room_name: str, t: int, milli_isu: str, total_power: str, items: str) -> int:
+    return batch.add("INSERT INTO room_snapshot(room_name, time, milli_isu, total_power, items) "
+                     "VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+                     "time=VALUES(time), milli_isu=VALUES(milli_isu), total_power=VALUES(total_power), items=VALUES(items)",
+                     (room_name, t, milli_isu, total_power, items))
+
+
+def select_room_events(batch: Batch, room_name: str) -> (int, int, int):
+    """room_snapshot と, それより後の adding と buying の行を読む. buying は
+    item_id ごとに ordinal の昇順に並べる"""
+    return (
+        select_snapshot(batch, room_name),
+        batch.add("SELECT time, isu FROM adding WHERE room_name = %s AND " + AFTER_SNAPSHOT,
+                  (room_name, room_name)),
+        batch.add("SELECT item_id, ordinal, time FROM buying WHERE room_name = %s AND " + AFTER_SNAPSHOT +
+                  " ORDER BY item_id, ordinal",
+                  (room_name, room_name)),
+    )
+
+
+def select_events_between(batch: Batch, room_name: str, after: int, until: int) -> (int, int):
+    """時刻が after より後で until 以前の adding と buying の行を読む"""
+    return (
+        batch.add("SELECT time, isu FROM adding WHERE room_name = %s AND time > %s AND time <= %s",
+                  (room_name, after, until)),
+        batch.add("SELECT item_id, ordinal, time FROM buying WHERE room_name = %s AND time > %s AND time <= %s",
+                  (room_name, after, until)),
+    )
+
+
+def select_buy_balance(batch: Batch, room_name: str, item_id: int, req_time: int) -> (int, int, int, int):
+    """buy_item の残高を求めるための room_snapshot, それより後の item_id の購入数,
+    時刻 req_time までの isu, すべての購入を読む"""
+    return (
+        select_snapshot(batch, room_name),
+        batch.add("SELECT COUNT(*) FROM buying WHERE room_name = %s AND item_id = %s AND " + AFTER_SNAPSHOT,
+                  (room_name, item_id, room_name)),
+        batch.add("SELECT isu FROM adding WHERE room_name = %s AND " + AFTER_SNAPSHOT + " AND time <= %s",
+                  (room_name, room_name, req_time)),
+        batch.add("SELECT item_id, ordinal, time FROM buying WHERE room_name = %s AND " + AFTER_SNAPSHOT,
+                  (room_name, room_name)),
+    )
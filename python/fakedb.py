@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""MySQL の代わりにメモリ上の表で game.py のクエリを実行する
+
+ベンチマーク用. install() で MySQLdb.connect を差し替えてから game を import する.
+game.py が発行する決まった形のクエリだけを解釈し, それ以外は ProgrammingError にする.
+";" でつないだ複数の文は1回の往復として順に実行し, 結果は nextset() で順に返す.
+FOR UPDATE と LOCK IN SHARE MODE はどちらも部屋ごとの排他ロックとして扱い,
+commit か rollback で外す. rollback ではそのトランザクションの書き込みを取り消す.
+
+    python fakedb.py [--port 5000] [--latency 0.2]
+
+で app.py をこの DB で起動する. latency はクエリ1回ごとに待つミリ秒.
+"""
+
+import argparse
+from collections import defaultdict
+import re
+import threading
+import time
+
+import MySQLdb
+
+
+def make_items(n: int = 13) -> dict:
+    """m_item と同じ形の, 後ろほど高価で強いアイテムマスタ"""
+    return {
+        i: {
+            "item_id": i,
+            "power1": i, "power2": i + 1, "power3": i, "power4": i + 1,
+            "price1": i, "price2": i + 2, "price3": i, "price4": i + 2,
+        } for i in range(1, n + 1)
+    }
+
+
+class Database:
+    """isudb の表. 1つの Database を全コネクションで共有する"""
+
+    def __init__(self, m_items: dict, latency: float = 0.0):
+        self.m_items = m_items
+        self.latency = latency  # 秒
+        self.lock = threading.Lock()  # 表を読み書きする間だけ取る
+        self.room_time = {}  # room_name: time
+        self.adding = defaultdict(dict)  # room_name: {time: isu}
+        self.buying = defaultdict(dict)  # room_name: {(item_id, ordinal): time}
+        self.room_snapshot = {}  # room_name: (time, milli_isu, total_power, items)
+        self.room_locks = defaultdict(threading.Lock)  # room_name: 行ロック
+        self.num_queries = 0
+
+    def connect(self, **kwargs) -> 'Connection':
+        return Connection(self)
+
+
+class Connection:
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._locked = set()  # このトランザクションで取った行ロックの room_name
+        self._undo = []
+
+    def cursor(self, cursorclass=None) -> 'Cursor':
+        return Cursor(self, as_dict=cursorclass is not None)
+
+    def commit(self):
+        self._wait()
+        self._undo = []
+        self._unlock()
+
+    def rollback(self):
+        self._wait()
+        with self.db.lock:
+            for f in reversed(self._undo):
+                f()
+        self._undo = []
+        self._unlock()
+
+    def ping(self, *args):
+        pass
+
+    def close(self):
+        self.rollback()
+
+    def lock_room(self, room_name: str):
+        if room_name not in self._locked:
+            with self.db.lock:
+                lock = self.db.room_locks[room_name]
+            lock.acquire()
+            self._locked.add(room_name)
+
+    def _unlock(self):
+        for room_name in self._locked:
+            self.db.room_locks[room_name].release()
+        self._locked.clear()
+
+    def _wait(self):
+        if self.db.latency:
+            time.sleep(self.db.latency)
+
+
+_handlers = []  # (compiled regex, handler)
+
+AFTER_SNAPSHOT = re.compile(r"time > IFNULL\(\(SELECT time FROM room_snapshot WHERE room_name = %s\), (-?\d+)\)")
+
+
+def time_range(m, group: int, args: list) -> (int, int):
+    """group 番目と次のグループの "AND time > %s", "AND time <= %s" の有無から
+    (after, until) を返す"""
+    args = list(args)
+    after = args.pop(0) if m.group(group) else float("-inf")
+    until = args.pop(0) if m.group(group + 1) else float("inf")
+    return after, until
+
+
+def query(pattern: str):
+    def register(f):
+        _handlers.append((re.compile(pattern + "$"), f))
+        return f
+    return register
+
+
+class Cursor:
+
+    def __init__(self, conn: Connection, as_dict: bool = False):
+        self.conn = conn
+        self.as_dict = as_dict
+        self._rows = []
+        self._results = []  # まだ nextset() で返していない文の結果
+
+    def execute(self, sql: str, args=()):
+        """";" でつないだ文を順に実行する. 失敗した文より後は実行しない"""
+        args = list(args or ())
+        self.conn._wait()
+        results = []
+        for statement in sql.split(";"):
+            n = statement.count("%s")
+            results.append(self._execute(statement, args[:n]))
+            args = args[n:]
+        self._rows = results[0]
+        self._results = results[1:]
+        return len(self._rows)
+
+    def nextset(self):
+        if not self._results:
+            return None
+        self._rows = self._results.pop(0)
+        return True
+
+    def _execute(self, sql: str, args: list) -> list:
+        sql = " ".join(sql.split())
+        m = AFTER_SNAPSHOT.search(sql)
+        if m:
+            # room_snapshot の時刻を読む副問い合わせは先に値にする
+            i = sql[:m.start()].count("%s")
+            with self.conn.db.lock:
+                row = self.conn.db.room_snapshot.get(args[i])
+            args = args[:i] + [int(m.group(1)) if row is None else row[0]] + args[i + 1:]
+            sql = sql[:m.start()] + "time > %s" + sql[m.end():]
+        for pattern, handler in _handlers:
+            m = pattern.match(sql)
+            if m:
+                break
+        else:
+            raise MySQLdb.ProgrammingError(f"fakedb does not support: {sql}")
+
+        room_name = args[0] if args and isinstance(args[0], str) else None
+        if room_name is not None and (" FOR UPDATE" in sql or "LOCK IN SHARE MODE" in sql):
+            # 表のロックを取る前に行ロックを待つ
+            self.conn.lock_room(room_name)
+        db = self.conn.db
+        with db.lock:
+            db.num_queries += 1
+            rows = handler(self, db, m, args)
+        return list(rows or [])
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._rows = []
+        self._results = []
+
+    def undo(self, f):
+        self.conn._undo.append(f)
+
+    @query(r"SELECT (\*|[\w, ]+) FROM m_item")
+    def _select_m_item(self, db, m, args):
+        keys = ("item_id", "power1", "power2", "power3", "power4", "price1", "price2", "price3", "price4")
+        if self.as_dict:
+            return [dict(item) for item in db.m_items.values()]
+        if m.group(1) != "*":
+            keys = m.group(1).split(", ")
+        return [tuple(item[k] for k in keys) for item in db.m_items.values()]
+
+    @query(r"COMMIT")
+    def _commit(self, db, m, args):
+        self.conn._undo = []
+        self.conn._unlock()
+
+    @query(r"TRUNCATE TABLE (\w+)")
+    def _truncate(self, db, m, args):
+        getattr(db, m.group(1)).clear()
+
+    @query(r"SELECT floor\(unix_timestamp\((?:current_timestamp|sysdate)\(3\)\)\*1000\)")
+    def _current_time(self, db, m, args):
+        return [(int(time.time() * 1000),)]
+
+    @query(r"INSERT INTO room_time\(room_name, time\) VALUES \(%s, 0\) ON DUPLICATE KEY UPDATE time = time")
+    def _insert_room_time(self, db, m, args):
+        room_name, = args
+        if room_name not in db.room_time:
+            db.room_time[room_name] = 0
+            self.undo(lambda: db.room_time.pop(room_name, None))
+
+    @query(r"SELECT time(, floor\(unix_timestamp\(sysdate\(3\)\)\*1000\))? FROM room_time WHERE room_name = %s "
+           r"(FOR UPDATE|LOCK IN SHARE MODE)")
+    def _select_room_time(self, db, m, args):
+        if m.group(1):
+            return [(db.room_time[args[0]], int(time.time() * 1000))]
+        return [(db.room_time[args[0]],)]
+
+    @query(r"UPDATE room_time SET time = %s WHERE room_name = %s")
+    def _update_room_time(self, db, m, args):
+        t, room_name = args
+        old = db.room_time[room_name]
+        db.room_time[room_name] = t
+        self.undo(lambda: db.room_time.__setitem__(room_name, old))
+
+    @query(r"INSERT INTO adding\(room_name, time, isu\) VALUES .* ON DUPLICATE KEY UPDATE isu=isu")
+    def _insert_adding_zero(self, db, m, args):
+        for room_name, t in zip(args[::2], args[1::2]):
+            rows = db.adding[room_name]
+            if t not in rows:
+                rows[t] = "0"
+                self.undo(lambda rows=rows, t=t: rows.pop(t, None))
+
+    @query(r"INSERT INTO adding\(room_name, time, isu\) VALUES .* ON DUPLICATE KEY UPDATE isu=VALUES\(isu\)")
+    def _upsert_adding(self, db, m, args):
+        for room_name, t, isu in zip(args[::3], args[1::3], args[2::3]):
+            rows = db.adding[room_name]
+            old = rows.get(t)
+            rows[t] = str(isu)
+            if old is None:
+                self.undo(lambda rows=rows, t=t: rows.pop(t, None))
+            else:
+                self.undo(lambda rows=rows, t=t, old=old: rows.__setitem__(t, old))
+
+    @query(r"SELECT time, isu FROM adding WHERE room_name = %s AND time IN \(.*\) FOR UPDATE")
+    def _select_adding_in(self, db, m, args):
+        rows = db.adding[args[0]]
+        return [(t, rows[t]) for t in args[1:] if t in rows]
+
+    @query(r"SELECT (time, isu|isu) FROM adding WHERE room_name ?= ?%s( AND time > %s)?( AND time <= %s)?")
+    def _select_adding(self, db, m, args):
+        after, until = time_range(m, 2, args[1:])
+        rows = [(t, isu) for t, isu in db.adding[args[0]].items() if after < t <= until]
+        if m.group(1) == "isu":
+            return [(isu,) for _, isu in rows]
+        return rows
+
+    @query(r"SELECT COUNT\(\*\) FROM buying WHERE room_name = %s AND item_id = %s( AND time > %s)?")
+    def _count_buying(self, db, m, args):
+        room_name, item_id = args[:2]
+        after = args[2] if m.group(1) else -1
+        return [(sum(1 for (i, _), t in db.buying[room_name].items() if i == item_id and t > after),)]
+
+    @query(r"SELECT item_id, ordinal, time FROM buying WHERE room_name ?= ?%s( AND time > %s)?( AND time <= %s)?"
+           r"( ORDER BY item_id, ordinal)?")
+    def _select_buying(self, db, m, args):
+        after, until = time_range(m, 1, args[1:])
+        return sorted((i, o, t) for (i, o), t in db.buying[args[0]].items() if after < t <= until)
+
+    @query(r"CREATE TABLE IF NOT EXISTS room_snapshot \(.*\).*")
+    def _create_room_snapshot(self, db, m, args):
+        pass
+
+    @query(r"SELECT time, milli_isu, total_power, items FROM room_snapshot WHERE room_name = %s")
+    def _select_room_snapshot(self, db, m, args):
+        row = db.room_snapshot.get(args[0])
+        return [] if row is None else [row]
+
+    @query(r"INSERT INTO room_snapshot\(room_name, time, milli_isu, total_power, items\) "
+           r"VALUES \(%s, %s, %s, %s, %s\) ON DUPLICATE KEY UPDATE .*")
+    def _upsert_room_snapshot(self, db, m, args):
+        room_name = args[0]
+        old = db.room_snapshot.get(room_name)
+        db.room_snapshot[room_name] = tuple(args[1:])
+        if old is None:
+            self.undo(lambda: db.room_snapshot.pop(room_name, None))
+        else:
+            self.undo(lambda: db.room_snapshot.__setitem__(room_name, old))
+
+    @query(r"INSERT INTO buying\(room_name, item_id, ordinal, time\) VALUES ?\(%s, %s, %s, %s\)")
+    def _insert_buying(self, db, m, args):
+        room_name, item_id, ordinal, t = args
+        rows = db.buying[room_name]
+        if (item_id, ordinal) in rows:
+            raise MySQLdb.IntegrityError(f"Duplicate entry '{room_name}-{item_id}-{ordinal}'")
+        rows[(item_id, ordinal)] = t
+        self.undo(lambda: rows.pop((item_id, ordinal), None))
+
+
+def install(m_items: dict = None, latency: float = 0.0) -> Database:
+    """MySQLdb.connect をメモリ上の Database につなぐように差し替える"""
+    db = Database(make_items() if m_items is None else m_items, latency)
+    MySQLdb.connect = db.connect
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app.py をメモリ上の DB で起動する")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.0, help="クエリごとの待ち時間 (ミリ秒)")
+    args = parser.parse_args()
+
+    install(latency=args.latency / 1000)
+    from aiohttp import web
+    import app
+    web.run_app(app.app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
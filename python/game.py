@@ -1,15 +1,26 @@
+from array import array
 import asyncio
-from collections import defaultdict, namedtuple
+import bisect
+from collections import OrderedDict, defaultdict, deque, namedtuple
+import concurrent.futures
+import functools
 import logging
 import os
 import sys
+import threading
 import time
 
+import aiohttp
 # namedtuple を dict として出力するために標準ライブラリの json ではなく
 # simplejson を使います。
 import simplejson
 import MySQLdb
 
+import dal
+import stats
+import wire
+from wire import StatusFrame
+
 
 # types for JSON
 Schedule = namedtuple("Schedule", ("time", "milli_isu", "total_power"))
@@ -38,28 +49,165 @@ def connect_db():
             "password": passwd,
             "charset": "utf8mb4",
             "db": "isudb",
+            "client_flag": dal.CLIENT_FLAG,
         }
     return MySQLdb.connect(**_db_info)
 
+
+class ConnectionPool:
+    """run_in_executor のワーカースレッドから共有する MySQL のコネクションプール
+
+    同時に開くコネクションは max_size 本まで. 空きがなければ返却を待つ.
+    しばらく使っていないコネクションは貸し出す前に ping し,
+    max_age 秒より古いものは閉じて作り直す.
+    返却時には rollback してトランザクションを必ず終わらせる.
+    """
+
+    def __init__(self, connect, max_size: int = 16, max_age: float = 600.0, ping_interval: float = 10.0):
+        self._connect = connect
+        self.max_size = max_size
+        self.max_age = max_age
+        self.ping_interval = ping_interval
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, created_at, released_at)
+        self._created_at = {}  # id(conn): created_at
+        self._size = 0
+
+        self.num_acquired = 0
+        self.num_waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.num_created = 0
+        self.num_recycled = 0
+        self.num_broken = 0
+
+    def acquire(self):
+        start = time.perf_counter()
+        waited = False
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                waited = True
+                self._cond.wait()
+            if self._idle:
+                conn, created_at, released_at = self._idle.pop()
+            else:
+                conn = None
+                self._size += 1
+
+            wait = time.perf_counter() - start
+            self.num_acquired += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            if waited:
+                self.num_waited += 1
+
+        try:
+            if conn is not None:
+                now = time.time()
+                if now - created_at > self.max_age:
+                    self.num_recycled += 1
+                    self._close(conn)
+                    conn = None
+                elif now - released_at > self.ping_interval:
+                    try:
+                        conn.ping()
+                    except MySQLdb.Error:
+                        self.num_broken += 1
+                        self._close(conn)
+                        conn = None
+            if conn is None:
+                conn = self._connect()
+                self.num_created += 1
+                self._created_at[id(conn)] = time.time()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def release(self, conn, rollback: bool = True):
+        """rollback が偽なら, 呼び出し側がトランザクションを終えているものとして
+        rollback の往復を省く"""
+        if rollback:
+            try:
+                conn.rollback()
+            except MySQLdb.Error:
+                self.num_broken += 1
+                self.discard(conn)
+                return
+        with self._cond:
+            self._idle.append((conn, self._created_at.get(id(conn), 0), time.time()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        """壊れたコネクションを閉じてプールから外す"""
+        self._close(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _close(self, conn):
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "acquired": self.num_acquired,
+                "waited": self.num_waited,
+                "wait_total": self.wait_total,
+                "wait_max": self.wait_max,
+                "created": self.num_created,
+                "recycled": self.num_recycled,
+                "broken": self.num_broken,
+            }
+
+
+db_pool = ConnectionPool(connect_db, max_size=int(os.environ.get("ISU_DB_POOL_SIZE", "16")))
+
+
 def get_m_items():
+    """m_item を読む. 起動時に呼ぶので, 後から足した表がなければ同じ往復で作る"""
     conn = connect_db()
-    cur = conn.cursor(MySQLdb.cursors.DictCursor)
-    cur.execute("SELECT * FROM m_item")
-    m_items = {m["item_id"]: m for m in cur}
-    cur.close()
-    return m_items
+    batch = dal.Batch()
+    dal.create_tables(batch)
+    items = dal.select_m_items(batch)
+    with dal.Session(conn, "initialize") as session:
+        rows = session.run(batch)[items]
+    conn.close()
+    return {row[0]: dict(zip(dal.M_ITEM_COLUMNS, row)) for row in rows}
 
 m_items = get_m_items()
 
 def initialize():
-    conn = connect_db()
+    batch = dal.Batch()
+    dal.create_tables(batch)
+    for table in ("adding", "buying", "room_time", "room_snapshot"):
+        batch.add("TRUNCATE TABLE " + table)
+    conn = db_pool.acquire()
     try:
-        cur = conn.cursor()
-        cur.execute("TRUNCATE TABLE adding")
-        cur.execute("TRUNCATE TABLE buying")
-        cur.execute("TRUNCATE TABLE room_time")
+        with dal.Session(conn, "initialize") as session:
+            session.run(batch)
     finally:
-        conn.close()
+        db_pool.release(conn)
+    clear_local_state()
+
+
+def clear_local_state():
+    """このプロセスがメモリ上に持っている部屋の状態と集計を捨てる.
+    テーブルを空にした後, 部屋を担当するすべてのプロセスで呼ぶ"""
+    clear_room_states()
+    status_cache.clear()
+    compactor.clear()
+    push_totals.clear()
+    stats.reset()
+    dal.reset()
 
 
 def calc_item_power(m: dict, count : int) -> int:
@@ -80,66 +228,447 @@ def calc_item_price(m: dict, count : int) -> int:
     return (c * count + 1) * (d ** (a * count + b))
 
 
+# calc_item_price, calc_item_power の表に載せる count の上限.
+# これより大きい count は毎回計算する.
+ITEM_TABLE_MAX_COUNT = 1024
+
+
+class ItemTable:
+    """アイテムマスタ1つ分の価格と生産力の表
+
+    count 個目の価格, 生産力と, 1個目から count 個目までの累積和を
+    必要になったところまで遅延して計算して保持する.
+    """
+
+    def __init__(self, m: dict, max_count: int = ITEM_TABLE_MAX_COUNT):
+        self.m = m
+        self.max_count = max_count
+        self.lock = threading.Lock()
+        # index は count. 累積和の index 0 は 0 個分
+        self.price = [calc_item_price(m, 0)]
+        self.power = [calc_item_power(m, 0)]
+        self.price_sum = [0]
+        self.power_sum = [0]
+
+    def _grow(self, count: int):
+        with self.lock:
+            for n in range(len(self.price), min(count, self.max_count) + 1):
+                price = calc_item_price(self.m, n)
+                power = calc_item_power(self.m, n)
+                self.price.append(price)
+                self.power.append(power)
+                self.price_sum.append(self.price_sum[-1] + price)
+                self.power_sum.append(self.power_sum[-1] + power)
+
+    def get_price(self, count: int) -> int:
+        if count < len(self.price):
+            return self.price[count]
+        if count > self.max_count:
+            return calc_item_price(self.m, count)
+        self._grow(count)
+        return self.price[count]
+
+    def get_power(self, count: int) -> int:
+        if count < len(self.power):
+            return self.power[count]
+        if count > self.max_count:
+            return calc_item_power(self.m, count)
+        self._grow(count)
+        return self.power[count]
+
+    def get_price_sum(self, count: int) -> int:
+        """1個目から count 個目までの価格の合計"""
+        if count >= len(self.price_sum):
+            self._grow(count)
+        if count < len(self.price_sum):
+            return self.price_sum[count]
+        return self.price_sum[-1] + sum(calc_item_price(self.m, n) for n in range(self.max_count + 1, count + 1))
+
+    def get_power_sum(self, count: int) -> int:
+        """1個目から count 個目までの生産力の合計"""
+        if count >= len(self.power_sum):
+            self._grow(count)
+        if count < len(self.power_sum):
+            return self.power_sum[count]
+        return self.power_sum[-1] + sum(calc_item_power(self.m, n) for n in range(self.max_count + 1, count + 1))
+
+
+_ITEM_KEYS = ("power1", "power2", "power3", "power4", "price1", "price2", "price3", "price4")
+
+
+@functools.lru_cache(maxsize=64)
+def _item_table(key: tuple) -> ItemTable:
+    return ItemTable(dict(zip(_ITEM_KEYS, key)))
+
+
+def item_table(m: dict) -> ItemTable:
+    """アイテムマスタ m の ItemTable を返す. 係数が同じなら同じ表を共有する.
+    一度引いた表は m の "_table" に置いておき, 次からは dict を1回引くだけにする"""
+    table = m.get("_table")
+    if table is None:
+        table = m["_table"] = _item_table(tuple(m[k] for k in _ITEM_KEYS))
+    return table
+
+
+def get_item_price(m: dict, count: int) -> int:
+    """calc_item_price と同じ値を表から引く"""
+    table = m.get("_table")
+    if table is None:
+        table = item_table(m)
+    return table.get_price(count)
+
+
+def get_item_power(m: dict, count: int) -> int:
+    """calc_item_power と同じ値を表から引く"""
+    table = m.get("_table")
+    if table is None:
+        table = item_table(m)
+    return table.get_power(count)
+
+
+_LOG10_2 = 0.30102999566398120  # log10(2)
+
+
+@functools.lru_cache(maxsize=4096)
+def _pow10(n: int) -> int:
+    return 10 ** n
+
+
 # JSON中で利用する10進指数表記
 # [x, y] = x * 10^y
+#
+# str(x) の先頭15文字を仮数にするのと同じ結果を返す.
+# 巨大な x の10進文字列変換は遅いので, bit_length から桁数を少なめに
+# 見積もって割り, はみ出した分だけ10で割って補正する.
+# 負数は '-' も1文字と数えるので仮数は14桁になる.
 def int2exp(x: int) -> (int, int):
-    s = str(x)
-    if not s:
-        return (0, 0)
-    if len(s) <= 15:
+    if x < 0:
+        width = 14
+        n = -x
+    else:
+        width = 15
+        n = x
+
+    limit = _pow10(width)
+    if n < limit:
         return (x, 0)
-    return (int(s[:15]), len(s)-15)
+
+    # n の桁数は floor((bit_length-1) * log10(2)) + 1 以上なので
+    # y は width+1 桁以上になる. 浮動小数点の誤差を見込んでさらに1桁余分に取る
+    k = int((n.bit_length() - 1) * _LOG10_2) - width - 1
+    if k > 0:
+        y = n // _pow10(k)
+    else:
+        k = 0
+        y = n
+    while y >= limit:
+        y //= 10
+        k += 1
+
+    if x < 0:
+        y = -y
+    return (y, k)
+
+
+class Int2ExpTimer:
+    """int2exp の代わりに calc_status_checkpoint に渡し, かかった秒数を total に足す.
+    1回ごとに時間を測るので, 抜き出した一部の計算にだけ使う"""
+
+    __slots__ = ("total", )
+
+    def __init__(self):
+        self.total = 0.0
+
+    def __call__(self, x: int) -> (int, int):
+        start = time.perf_counter()
+        r = int2exp(x)
+        self.total += time.perf_counter() - start
+        return r
+
+
+class Checkpoint:
+    """時刻 time 以前のイベントを畳み込んだ集計値
+
+    calc_status_checkpoint はこれを起点にして, まだ畳み込んでいない
+    イベントだけを再生する. 一度作ったものは書き換えない.
+    """
+
+    def __init__(self, time: int = 0, milli_isu: int = 0, total_power: int = 0,
+                 item_power: dict = None, item_built: dict = None, item_bought: dict = None):
+        self.time = time
+        self.milli_isu = milli_isu
+        self.total_power = total_power
+        self.item_power = item_power or {}  # ItemID: power
+        self.item_built = item_built or {}  # ItemID: BuiltCount
+        self.item_bought = item_bought or {}  # ItemID: BoughtCount
+
+    # プロセスプールに送るときに属性名を pickle しないようにする
+    def __getstate__(self):
+        return (self.time, self.milli_isu, self.total_power,
+                self.item_power, self.item_built, self.item_bought)
+
+    def __setstate__(self, state):
+        (self.time, self.milli_isu, self.total_power,
+         self.item_power, self.item_built, self.item_bought) = state
+
+
+def fold_checkpoint(cp: Checkpoint, mitems: dict, addings: list, buyings: list, t: int):
+    """cp を時刻 t まで進め, 時刻 t 以前のイベントを畳み込む
+
+    addings は (time, isu), buyings は (item_id, ordinal, time) の並びなら何でも良い.
+    新しい Checkpoint と, 畳み込まなかった (t より後の) addings, buyings を返す.
+    t 以前のイベントは cp.time より前のものでもそのまま畳み込める.
+    """
+    if t < cp.time:
+        raise ValueError(f"can not fold back: checkpoint={cp.time}, t={t}")
+
+    milli_isu = cp.milli_isu + cp.total_power * (t - cp.time)
+    total_power = cp.total_power
+    item_power = dict(cp.item_power)
+    item_built = dict(cp.item_built)
+    item_bought = dict(cp.item_bought)
+
+    rest_addings = []
+    for a_time, isu in addings:
+        if a_time <= t:
+            milli_isu += int(isu) * 1000
+        else:
+            rest_addings.append(Adding(a_time, isu))
+
+    rest_buyings = []
+    for item_id, ordinal, b_time in buyings:
+        if b_time > t:
+            rest_buyings.append(Buying(item_id, ordinal, b_time))
+            continue
+        m = mitems[item_id]
+        item_bought[item_id] = item_bought.get(item_id, 0) + 1
+        item_built[item_id] = item_built.get(item_id, 0) + 1
+        milli_isu -= get_item_price(m, ordinal) * 1000
+        power = get_item_power(m, ordinal)
+        item_power[item_id] = item_power.get(item_id, 0) + power
+        total_power += power
+        milli_isu += power * (t - b_time)
+
+    cp = Checkpoint(t, milli_isu, total_power, item_power, item_built, item_bought)
+    return cp, rest_addings, rest_buyings
+
+
+class RoomHistory:
+    """部屋のイベント列を namedtuple のリストの代わりに配列で持つ
+
+    adding は時刻順の time, isu の配列, buying は追加順の
+    item_id, ordinal, time の配列にする. isu は桁数が大きいのでリストで持つ.
+    """
+
+    __slots__ = ("add_time", "add_isu", "buy_item_id", "buy_ordinal", "buy_time")
+
+    def __init__(self):
+        self.add_time = array("q")
+        self.add_isu = []
+        self.buy_item_id = array("i")
+        self.buy_ordinal = array("i")
+        self.buy_time = array("q")
+
+    @classmethod
+    def from_lists(cls, addings: list, buyings: list) -> 'RoomHistory':
+        h = cls()
+        for a_time, isu in addings:
+            h.add_isu_at(a_time, int(isu))
+        for item_id, ordinal, b_time in buyings:
+            h.add_buying(item_id, ordinal, b_time)
+        return h
+
+    def __len__(self) -> int:
+        return len(self.add_time) + len(self.buy_time)
+
+    def __getstate__(self):
+        return (self.add_time, self.add_isu, self.buy_item_id, self.buy_ordinal, self.buy_time)
+
+    def __setstate__(self, state):
+        self.add_time, self.add_isu, self.buy_item_id, self.buy_ordinal, self.buy_time = state
+
+    def add_isu_at(self, t: int, isu: int):
+        k = bisect.bisect_left(self.add_time, t)
+        if k < len(self.add_time) and self.add_time[k] == t:
+            self.add_isu[k] += isu
+        else:
+            self.add_time.insert(k, t)
+            self.add_isu.insert(k, isu)
+
+    def add_buying(self, item_id: int, ordinal: int, t: int):
+        self.buy_item_id.append(item_id)
+        self.buy_ordinal.append(ordinal)
+        self.buy_time.append(t)
+
+    def addings(self):
+        """(time, isu) の並び"""
+        return zip(self.add_time, self.add_isu)
+
+    def buyings(self):
+        """(item_id, ordinal, time) の並び"""
+        return zip(self.buy_item_id, self.buy_ordinal, self.buy_time)
+
+    def copy(self) -> 'RoomHistory':
+        h = RoomHistory()
+        h.add_time = array("q", self.add_time)
+        h.add_isu = list(self.add_isu)
+        h.buy_item_id = array("i", self.buy_item_id)
+        h.buy_ordinal = array("i", self.buy_ordinal)
+        h.buy_time = array("q", self.buy_time)
+        return h
+
+    def split(self, t: int) -> 'RoomHistory':
+        """時刻 t 以前のイベントを取り除いて返す"""
+        old = RoomHistory()
+        k = bisect.bisect_right(self.add_time, t)
+        old.add_time, self.add_time = self.add_time[:k], self.add_time[k:]
+        old.add_isu, self.add_isu = self.add_isu[:k], self.add_isu[k:]
+
+        if any(b_time <= t for b_time in self.buy_time):
+            rest = RoomHistory()
+            for item_id, ordinal, b_time in self.buyings():
+                (old if b_time <= t else rest).add_buying(item_id, ordinal, b_time)
+            self.buy_item_id = rest.buy_item_id
+            self.buy_ordinal = rest.buy_ordinal
+            self.buy_time = rest.buy_time
+        return old
 
 
 def calc_status(current_time: int, mitems: dict, addings: list, buyings: list):
+    return calc_status_checkpoint(current_time, mitems, Checkpoint(), addings, buyings)
+
+
+def calc_status_history(current_time: int, mitems: dict, cp: Checkpoint, history: RoomHistory, conv=int2exp):
+    return calc_status_checkpoint(current_time, mitems, cp, history.addings(), history.buyings(), conv)
+
+
+def advance_status(status: GameStatus, mitems: dict, cp: Checkpoint, history: RoomHistory, new_time: int):
+    """cp.time に calc_status_history(cp.time, mitems, cp, history) で求めた status を
+    new_time まで進める. history は cp.time より後のイベント.
+
+    new_time までにイベントがなく, 先読みの窓 (new_time+1000 まで) に
+    新しく入るイベントもなければ, 変わるのは schedule の先頭と on_sale だけなので
+    その2つだけ計算し直す. そうでなければ None を返す.
+    """
+    if new_time < cp.time:
+        return None
+    window = new_time + 1000
+
+    adding_at = {}  # time: isu
+    power_at = defaultdict(int)  # time: 増える power
+    total_milli_isu = cp.milli_isu + cp.total_power * (new_time - cp.time)
+    for a_time, isu in history.addings():
+        if a_time <= new_time or cp.time + 1000 < a_time <= window:
+            return None
+        if a_time <= window:
+            adding_at[a_time] = int(isu)
+    for item_id, ordinal, b_time in history.buyings():
+        if b_time <= new_time or cp.time + 1000 < b_time <= window:
+            return None
+        m = mitems[item_id]
+        total_milli_isu -= get_item_price(m, ordinal) * 1000
+        if b_time <= window:
+            power_at[b_time] += get_item_power(m, ordinal)
+    total_power = cp.total_power
+
+    item_on_sale = {}  # ItemID: on_sale
+    item_target = {}
+    for item in status.items:
+        target = get_item_price(mitems[item.item_id], item.count_bought + 1) * 1000
+        item_target[item.item_id] = target
+        if total_milli_isu >= target:
+            item_on_sale[item.item_id] = 0
+
+    item_order = {id: i for i, id in enumerate(mitems)}
+    not_on_sale = sorted((id for id in mitems if id not in item_on_sale), key=item_target.get)
+    schedule0 = Schedule(new_time, int2exp(total_milli_isu), int2exp(total_power))
+
+    # calc_status_checkpoint の先読みと同じ割り算で購入可能になる時刻を求める
+    ts = sorted(set(adding_at) | set(power_at))
+    ct = new_time
+    for i, t in enumerate([new_time] + ts):
+        nt = ts[i] if i < len(ts) else window + 1
+        total_milli_isu += total_power * (t - ct) + adding_at.get(t, 0) * 1000
+        total_power += power_at.get(t, 0)
+        ct = t
+
+        found = []
+        for id in not_on_sale:
+            target = item_target[id]
+            if total_milli_isu + (nt-1 - t) * total_power < target:
+                break
+            need = target - total_milli_isu
+            r = t if need <= 0 else t + (need + total_power - 1) // total_power
+            found.append((item_order[id], id, r))
+        if found:
+            for _, id, r in sorted(found):
+                item_on_sale[id] = r
+            not_on_sale = not_on_sale[len(found):]
+
+    return status._replace(
+        time=new_time,
+        schedule=[schedule0] + status.schedule[1:],
+        on_sale=[OnSale(id, t) for id, t in item_on_sale.items()])
+
+
+def calc_status_checkpoint(current_time: int, mitems: dict, cp: Checkpoint, addings: list, buyings: list,
+                           conv=int2exp):
+    """cp から始めて addings, buyings を再生し current_time の状態を計算する
+
+    addings は (time, isu), buyings は (item_id, ordinal, time) の並びなら何でも良い.
+    conv は int2exp の代わりに使う関数 (Int2ExpTimer で時間を測るときに渡す).
+    """
+    if current_time < cp.time:
+        raise ValueError(f"current_time is before checkpoint: checkpoint={cp.time}, current_time={current_time}")
+
     # 1ミリ秒に生産できる椅子の単位をミリ椅子とする
-    total_milli_isu : int = 0
-    total_power : int = 0
+    total_milli_isu : int = cp.milli_isu + cp.total_power * (current_time - cp.time)
+    total_power : int = cp.total_power
 
-    item_power = {itemID: 0 for itemID in mitems}  # ItemID: power
+    item_power = {itemID: cp.item_power.get(itemID, 0) for itemID in mitems}  # ItemID: power
     item_price = {}  # ItemID: price
     item_on_sale = {}  # ItemID: on_sale
-    item_built = defaultdict(int)  # ItemID: BuiltCount
-    item_bought = defaultdict(int)
+    item_built = defaultdict(int, cp.item_built)  # ItemID: BuiltCount
+    item_bought = defaultdict(int, cp.item_bought)
     item_building = {itemID: [] for itemID in mitems}
 
     item_power0 = {}
     item_built0 = {}
 
-    adding_at = {}
-    buying_at = defaultdict(list)
+    adding_at = {}  # time: isu
+    buying_at = defaultdict(list)  # time: [(item_id, ordinal)]
 
-    for a in addings:
-        if a.time <= current_time:
-            total_milli_isu += int(a.isu) * 1000
+    for a_time, isu in addings:
+        if a_time <= current_time:
+            total_milli_isu += int(isu) * 1000
         else:
-            adding_at[a.time] = a
+            adding_at[a_time] = isu
 
-    for b in buyings:
-        m = mitems[b.item_id]
-        item_bought[b.item_id] += 1
-        total_milli_isu -= calc_item_price(m, b.ordinal) * 1000
+    for item_id, ordinal, b_time in buyings:
+        m = mitems[item_id]
+        item_bought[item_id] += 1
+        total_milli_isu -= get_item_price(m, ordinal) * 1000
 
-        if b.time <= current_time:
-            item_built[b.item_id] += 1
-            power = calc_item_power(m, item_bought[b.item_id])
-            item_power[b.item_id] += power
+        if b_time <= current_time:
+            item_built[item_id] += 1
+            power = get_item_power(m, ordinal)
+            item_power[item_id] += power
             total_power += power
-            total_milli_isu += power * (current_time - b.time)
+            total_milli_isu += power * (current_time - b_time)
         else:
-            buying_at[b.time].append(b)
+            buying_at[b_time].append((item_id, ordinal))
 
     for item_id, m in mitems.items():
-        item_power0[item_id] = int2exp(item_power[item_id])
+        item_power0[item_id] = conv(item_power[item_id])
         item_built0[item_id] = item_built[item_id]
-        price = calc_item_price(m, item_bought[item_id]+1)
+        price = get_item_price(m, item_bought[item_id]+1)
         item_price[item_id] = price
         if total_milli_isu >= price*1000:
             # 0 は 時刻 currentTime で購入可能であることを表す
             item_on_sale[item_id] = 0
 
     # current_time の状態
-    schedule = [Schedule(current_time, int2exp(total_milli_isu), int2exp(total_power))]
+    schedule = [Schedule(current_time, conv(total_milli_isu), conv(total_power))]
 
     ts = set()
     ts.add(0)
@@ -155,6 +684,10 @@ def calc_status(current_time: int, mitems: dict, addings: list, buyings: list):
     N = len(ts)
     ct = current_time
 
+    item_order = {id: i for i, id in enumerate(mitems)}
+    item_target = {id: item_price[id] * 1000 for id in mitems}
+    not_on_sale = sorted((id for id in mitems if id not in item_on_sale), key=item_target.get)
+
     for i in range(N):
         t = ts[i]
         nt = current_time + 1001
@@ -168,44 +701,51 @@ def calc_status(current_time: int, mitems: dict, addings: list, buyings: list):
 
         if t in adding_at:
             updated = True
-            total_milli_isu += int(adding_at[t].isu) * 1000
+            total_milli_isu += int(adding_at[t]) * 1000
 
         if t in buying_at:
             updated = True
             updated_ids = set()
 
-            for b in buying_at[t]:
-                m = mitems[b.item_id]
-                updated_ids.add(b.item_id)
-                item_built[b.item_id] += 1
+            for item_id, ordinal in buying_at[t]:
+                m = mitems[item_id]
+                updated_ids.add(item_id)
+                item_built[item_id] += 1
 
-                power = calc_item_power(m, b.ordinal)
-                item_power[b.item_id] += power
+                power = get_item_power(m, ordinal)
+                item_power[item_id] += power
                 total_power += power
 
             for id in updated_ids:
                 item_building[id].append(
-                    Building(t, item_built[id], int2exp(item_power[id]))
+                    Building(t, item_built[id], conv(item_power[id]))
                 )
 
         if updated:
             schedule.append(
-                Schedule(t, int2exp(total_milli_isu), int2exp(total_power)),
+                Schedule(t, conv(total_milli_isu), conv(total_power)),
             )
 
-        # 時刻 t で購入可能になったアイテムを記録する
-        for id in mitems:
-            if id in item_on_sale:
-                continue
-            if total_milli_isu + (nt-1 - t) * total_power >= item_price[id] * 1000:
-                l, r = t-1, nt-1
-                while r - l > 1:
-                    mid = (l+r)//2
-                    if (total_milli_isu + (mid - t) * total_power >= item_price[id] * 1000):
-                        r = mid
-                    else:
-                        l = mid
+        # 時刻 t で購入可能になったアイテムを記録する.
+        # total_milli_isu + (r - t) * total_power >= price * 1000 となる
+        # 最小の r (t <= r < nt) を割り算で求める.
+        # 安い順に見て, nt-1 までに買えないものがあればそれより高いものも買えない
+        found = []
+        for id in not_on_sale:
+            target = item_target[id]
+            if total_milli_isu + (nt-1 - t) * total_power < target:
+                break
+            need = target - total_milli_isu
+            if need <= 0:
+                r = t
+            else:
+                r = t + (need + total_power - 1) // total_power
+            found.append((item_order[id], id, r))
+        if found:
+            # on_sale の並びは元どおり時刻ごとに mitems の順にする
+            for _, id, r in sorted(found):
                 item_on_sale[id] = r
+            not_on_sale = not_on_sale[len(found):]
 
 #    # current_time+1000 までの状態
 #    for t in range(current_time+1, current_time+1001):
@@ -246,14 +786,14 @@ def calc_status(current_time: int, mitems: dict, addings: list, buyings: list):
 #            if total_milli_isu >= item_price[id] * 1000:
 #                item_on_sale[id] = t
 
-    gs_addings = list(adding_at.values())
+    gs_addings = [Adding(t, isu) for t, isu in adding_at.items()]
 
     gs_items = [
         Item(
             item_id,
             item_bought[item_id],
             item_built0[item_id],
-            int2exp(item_price[item_id]),
+            conv(item_price[item_id]),
             item_power0[item_id],
             item_building[item_id],
         ) for item_id in mitems]
@@ -268,256 +808,1452 @@ def calc_status(current_time: int, mitems: dict, addings: list, buyings: list):
         gs_on_sale)
 
 
-def update_room_time(conn, room_name: str, req_time: int) -> int:
-    """部屋のロックを取りタイムスタンプを更新する
+class RoomState:
+    """部屋ごとの状態をメモリ上に保持する
 
-    トランザクション開始後この関数を呼ぶ前にクエリを投げると、
-    そのトランザクション中の通常のSELECTクエリが返す結果がロック取得前の
-    状態になることに注意 (keyword: MVCC, repeatable read).
+    過去のイベントは Checkpoint に畳み込み, それ以降の adding, buying だけを
+    RoomHistory に持っておく. get_status はテーブルではなくここから読む.
+    テーブルは永続化とプロセス再起動後の復元 (load) のためだけに使う.
+    add_isu, buy_item はコミットした内容を lock を取ったまま反映する.
+    1つの部屋は1つのプロセスだけが担当することを前提にしている.
+
+    version は反映するたびに増やす. StatusCache は version が変わっていなければ
+    前回計算した status を使い回す.
     """
-    cur = conn.cursor()
 
-    # See page 13 and 17 in https://www.slideshare.net/ichirin2501/insert-51938787
-    cur.execute("INSERT INTO room_time(room_name, time) VALUES (%s, 0) ON DUPLICATE KEY UPDATE time = time", (room_name, ))
+    def __init__(self, room_name: str):
+        self.room_name = room_name
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.checkpoint = Checkpoint()
+        self.history = RoomHistory()  # checkpoint より後のイベント
+        self.item_bought = defaultdict(int)  # ItemID: 購入済みの数
+        self.calc_cost = 0.0  # calc_status にかかった秒数の移動平均
+        self.version = 0
+
+    def load(self, session: dal.Session):
+        """テーブルから状態を作り直す. self.lock を取ってから呼ぶこと
+
+        room_snapshot があればそこから始め, それより後のイベントだけを読む.
+        読み込みは1回の往復で行い, トランザクションも終える.
+        """
+        batch = dal.Batch()
+        snapshot, addings, buyings = dal.select_room_events(batch, self.room_name)
+        batch.commit()
+        results = session.run(batch)
+
+        self.checkpoint = load_snapshot(results[snapshot])
+        self.history = RoomHistory()
+        self.item_bought = defaultdict(int, self.checkpoint.item_bought)
+        self.version += 1
+        for (t, isu) in results[addings]:
+            self.history.add_isu_at(t, int(isu))
+        for (item_id, ordinal, t) in results[buyings]:
+            self.history.add_buying(item_id, ordinal, t)
+            self.item_bought[item_id] += 1
+        self.loaded = True
+
+    def add_isu(self, req_time: int, num_isu: int):
+        self.version += 1
+        if req_time <= self.checkpoint.time:
+            # 畳み込み済みの時刻へのコミットが遅れて届いた
+            self.checkpoint, _, _ = fold_checkpoint(
+                self.checkpoint, m_items, [(req_time, num_isu)], [], self.checkpoint.time)
+            return
+        self.history.add_isu_at(req_time, num_isu)
+
+    def buy_item(self, item_id: int, ordinal: int, req_time: int):
+        if self.item_bought[item_id] + 1 != ordinal:
+            # 他のプロセスが書き込んだなどで食い違っているので読み直させる
+            logging.warning("room state is stale: room=%s item_id=%s ordinal=%s",
+                            self.room_name, item_id, ordinal)
+            self.loaded = False
+            return
+        self.version += 1
+        self.item_bought[item_id] += 1
+        if req_time <= self.checkpoint.time:
+            self.checkpoint, _, _ = fold_checkpoint(
+                self.checkpoint, m_items, [], [(item_id, ordinal, req_time)], self.checkpoint.time)
+            return
+        self.history.add_buying(item_id, ordinal, req_time)
+
+    def milli_isu_at(self, t: int) -> int:
+        """buy_item が購入できるか判定する時刻 t の椅子の数 (ミリ椅子).
+        購入済みのアイテムの価格はすべて引いておく.
+        t が checkpoint より前なら None を返す. self.lock を取ってから呼ぶこと"""
+        cp = self.checkpoint
+        if t < cp.time:
+            return None
+        milli_isu = cp.milli_isu + cp.total_power * (t - cp.time)
+        for a_time, isu in self.history.addings():
+            if a_time <= t:
+                milli_isu += isu * 1000
+        for item_id, ordinal, b_time in self.history.buyings():
+            m = m_items[item_id]
+            milli_isu -= get_item_price(m, ordinal) * 1000
+            if b_time < t:
+                milli_isu += get_item_power(m, ordinal) * (t - b_time)
+        return milli_isu
+
+    def snapshot(self, current_time: int) -> (int, Checkpoint, RoomHistory):
+        """current_time までを畳み込み, version と calc_status_history に渡す
+        checkpoint と残りのイベントのコピーを返す"""
+        with self.lock:
+            if current_time > self.checkpoint.time:
+                old = self.history.split(current_time)
+                self.checkpoint, _, _ = fold_checkpoint(
+                    self.checkpoint, m_items, old.addings(), old.buyings(), current_time)
+            return self.version, self.checkpoint, self.history.copy()
+
+
+def load_snapshot(rows: list) -> Checkpoint:
+    """dal.select_snapshot で読んだ行を Checkpoint にして返す. なければ空の Checkpoint"""
+    return snapshot_checkpoint(*rows[0]) if rows else Checkpoint()
+
+
+def snapshot_checkpoint(t: int, milli_isu: str, total_power: str, items: str) -> Checkpoint:
+    """items は {item_id: [建てた数, power]}. 畳み込んだ購入はすべて建っている"""
+    item_built = {}
+    item_power = {}
+    for item_id, (built, power) in simplejson.loads(items).items():
+        item_built[int(item_id)] = built
+        item_power[int(item_id)] = int(power)
+    return Checkpoint(t, int(milli_isu), int(total_power), item_power, item_built, dict(item_built))
+
+
+def save_snapshot(batch: dal.Batch, room_name: str, cp: Checkpoint):
+    items = simplejson.dumps({
+        str(item_id): [built, str(cp.item_power.get(item_id, 0))]
+        for item_id, built in cp.item_built.items()})
+    dal.save_snapshot(batch, room_name, cp.time, str(cp.milli_isu), str(cp.total_power), items)
+
+
+def compact_room(room_name: str, horizon: int) -> bool:
+    """current_time - horizon 以前のイベントを room_snapshot に畳み込む
+
+    前回の snapshot より後で, 畳み込む時刻以前の行だけを読む. 部屋のロックを取るので
+    書き込み中の行を読み飛ばすことはなく, 畳み込んだ時刻以前への書き込みは
+    req_time が過去になるので以後は起きない. 畳み込んだ行は消さずに読まなくなるだけ.
+    """
+    conn = db_pool.acquire()
+    session = dal.Session(conn, "compact")
+    try:
+        with session:
+            batch = dal.Batch()
+            locked = dal.lock_room(batch, room_name)
+            snapshot = dal.select_snapshot(batch, room_name)
+            current_time, results = run_locked(session, batch, locked, 0)
+            t = current_time - horizon
+            cp = load_snapshot(results[snapshot])
+            if t <= cp.time:
+                session.rollback()
+                return False
+
+            batch = dal.Batch()
+            addings, buyings = dal.select_events_between(batch, room_name, cp.time, t)
+            results = session.run(batch)
+            cp, _, _ = fold_checkpoint(cp, m_items, results[addings], results[buyings], t)
+
+            batch = dal.Batch()
+            save_snapshot(batch, room_name, cp)
+            dal.update_room_time(batch, room_name, current_time)
+            batch.commit()
+            session.run(batch)
+            return True
+    finally:
+        db_pool.release(conn, session.in_transaction)
 
-    cur.execute("SELECT time FROM room_time WHERE room_name = %s FOR UPDATE", (room_name, ))
-    room_time = cur.fetchone()[0]
 
-    current_time = get_current_time(conn)
+class Compactor:
+    """このプロセスが持っている部屋を interval 秒ごとに compact_room する
+
+    前回から version が変わった部屋だけを1部屋ずつ畳み込む.
+    """
+
+    def __init__(self, interval: float = 5.0, horizon: int = 1000):
+        self.interval = interval
+        self.horizon = horizon
+        self._versions = {}  # room_name: 前回畳み込んだときの version
+        self._task = None
+        self.num_compacted = 0
+
+    def ensure_started(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            with _room_states_lock:
+                states = list(_room_states.values())
+            for state in states:
+                if not state.loaded or self._versions.get(state.room_name) == state.version:
+                    continue
+                version = state.version
+                try:
+                    if await loop.run_in_executor(None, compact_room, state.room_name, self.horizon):
+                        self.num_compacted += 1
+                    self._versions[state.room_name] = version
+                except Exception:
+                    logging.exception("fail to compact room: room=%s", state.room_name)
+
+    def clear(self):
+        self._versions.clear()
+
+
+# ISU_COMPACT_INTERVAL=0 にすると畳み込まない
+compactor = Compactor(interval=float(os.environ.get("ISU_COMPACT_INTERVAL", "5")))
+
+
+_room_states = {}  # room_name: RoomState
+_room_states_lock = threading.Lock()
+
+
+def get_room_state(room_name: str) -> RoomState:
+    """部屋の RoomState を返す. まだ読み込んでいなければテーブルから読み込む"""
+    with _room_states_lock:
+        state = _room_states.get(room_name)
+        if state is None:
+            state = _room_states[room_name] = RoomState(room_name)
+
+    with state.lock:
+        if not state.loaded:
+            conn = db_pool.acquire()
+            session = dal.Session(conn, "load")
+            try:
+                with session:
+                    state.load(session)
+            finally:
+                db_pool.release(conn, session.in_transaction)
+    return state
+
+
+def clear_room_states():
+    with _room_states_lock:
+        _room_states.clear()
+
+
+def run_locked(session: dal.Session, batch: dal.Batch, locked: int, req_time: int) -> (int, list):
+    """dal.lock_room から始まる batch を1回の往復で実行し, 現在時刻と各文の結果を返す
+
+    batch の残りの文は部屋のロックを取った後に実行されるので, 書き込み中の行を
+    読み飛ばすことはない. room_time は書き込みと同じ往復で dal.update_room_time で
+    更新すること (書き込まずに終わるなら更新しなくてよい).
+    """
+    start = time.monotonic()
+    results = session.run(batch)
+    end = time.monotonic()
+    room_time, db_time = results[locked][0]
+    return locked_current_time(room_time, int(db_time), start, end, req_time), results
+
+
+def locked_current_time(room_time: int, db_time: int, start: float, end: float, req_time: int) -> int:
+    """部屋のロックを取った往復で読んだ room_time と MySQL の時刻 db_time から現在時刻を決める"""
+    current_time = clock.peek()
+    if current_time is None or room_time > current_time:
+        # 他のプロセスの時計の方が進んでいたかもしれないので MySQL の時刻を使う
+        current_time = clock.measured(db_time, start, end)
 
     if room_time > current_time:
         raise RuntimeError(f"room_time is future: room_time={room_time}, req_time={req_time}")
 
     if req_time and req_time < current_time:
         raise RuntimeError(f"req_time is past: req_time={req_time}, current_time={current_time}")
-
-    cur.execute("UPDATE room_time SET time = %s WHERE room_name = %s", (current_time, room_name))
-    return current_time
-
-
-def update_room_time_shared_lock(conn, room_name: str) -> int:
-    cur = conn.cursor()
-    cur.execute("INSERT INTO room_time(room_name, time) VALUES (%s, 0) ON DUPLICATE KEY UPDATE time = time", (room_name, ))
-    cur.execute("SELECT time FROM room_time WHERE room_name = %s LOCK IN SHARE MODE", (room_name, ))
-    current_time = get_current_time(conn)
     return current_time
 
-def update_room_time_shared_lock_end(conn, room_name: str, current_time: int):
-    cur = conn.cursor()
-    cur.execute("UPDATE room_time SET time = %s WHERE room_name = %s", (current_time, room_name))
 
 def add_isu_profile(room_name: str, req_time: int, num_isu: int) -> bool:
     profiler = start_profile()
+    start = time.perf_counter()
     try:
         return add_isu(room_name, req_time, num_isu)
     finally:
-        end_profile(profiler)
+        end_profile(profiler, "addIsu", time.perf_counter() - start)
 
 
 def add_isu(room_name: str, req_time: int, num_isu: int) -> bool:
     #print(f"add_isu(room_name={room_name}, req_time={req_time})")
-    conn = connect_db()
+    return add_isu_batch(room_name, [(req_time, num_isu)])[0]
+
+
+def add_isu_batch_profile(room_name: str, requests: list) -> list:
+    profiler = start_profile()
+    start = time.perf_counter()
+    try:
+        return add_isu_batch(room_name, requests)
+    finally:
+        end_profile(profiler, "addIsu", time.perf_counter() - start)
+
+
+def add_isu_batch(room_name: str, requests: list) -> list:
+    """同じ部屋への複数の add_isu を1つのトランザクションで処理する
+
+    requests は (req_time, num_isu) のリスト. 同じ時刻のものはまとめて
+    1行に足し込む. それぞれ成功したかどうかのリストを返す.
+    """
+    state = get_room_state(room_name)
+    with stats.timer("addIsu", "pool"):
+        conn = db_pool.acquire()
+    session = dal.Session(conn, "addIsu")
     try:
-        update_room_time(conn, room_name, req_time)
-        cur = conn.cursor()
-        cur.execute("INSERT INTO adding(room_name, time, isu) VALUES (%s, %s, '0') ON DUPLICATE KEY UPDATE isu=isu",
-                    (room_name, req_time))
-
-        cur.execute("SELECT isu FROM adding WHERE room_name = %s AND time = %s FOR UPDATE",
-                    (room_name, req_time))
-        isu = int(cur.fetchone()[0])
-        isu += num_isu
-        isu = str(isu)
-        cur.execute("UPDATE adding SET isu=%s WHERE room_name=%s AND time=%s",
-                    (isu, room_name, req_time))
+        with session:
+            # ロックを取る往復で, 要求された時刻の今の行も読んでおく
+            batch, locked, rows = add_isu_read_batch(room_name, requests)
+            with stats.timer("addIsu", "lock"):
+                current_time, read = run_locked(session, batch, locked, 0)
+
+            results, adding = merge_add_isu_requests(requests, current_time)
+            if not adding:
+                session.rollback()
+                return results
+
+            batch = add_isu_write_batch(room_name, current_time, read[rows], adding)
+            with state.lock:
+                with stats.timer("addIsu", "commit"):
+                    session.run(batch)
+                for t in sorted(adding):
+                    state.add_isu(t, adding[t])
+            return results
     except Exception as e:
-        conn.rollback()
-        logging.exception("fail to add isu: room=%s time=%s isu=%s", room_name, req_time, num_isu)
-        return False
-    else:
-        conn.commit()
-        return True
+        logging.exception("fail to add isu: room=%s requests=%s", room_name, requests)
+        return [False] * len(requests)
     finally:
-        conn.close()
+        db_pool.release(conn, session.in_transaction)
+
+
+def merge_add_isu_requests(requests: list, current_time: int) -> (list, dict):
+    """(req_time, num_isu) のリストを時刻ごとにまとめる
+
+    それぞれ成功するかどうかのリストと, 時刻ごとに足す isu を返す.
+    current_time より前の要求は失敗にする.
+    """
+    results = []
+    adding = {}  # time: 足す isu
+    for req_time, num_isu in requests:
+        if req_time < current_time:
+            logging.warning("req_time is past: req_time=%s, current_time=%s", req_time, current_time)
+            results.append(False)
+            continue
+        adding[req_time] = adding.get(req_time, 0) + num_isu
+        results.append(True)
+    return results, adding
+
+
+def add_isu_read_batch(room_name: str, requests: list) -> (dal.Batch, int, int):
+    """部屋のロックを取り, requests の時刻の adding の行を読む batch を返す
+
+    部屋のロックを取ってから読むので, 行がなくても他の書き込みと競合しない.
+    過去の時刻の行も読むが, それは書き込まないので害はない.
+    """
+    batch = dal.Batch()
+    locked = dal.lock_room(batch, room_name)
+    rows = dal.select_adding_rows(batch, room_name, sorted({t for t, _ in requests}))
+    return batch, locked, rows
+
+
+def add_isu_write_batch(room_name: str, current_time: int, rows: list, adding: dict) -> dal.Batch:
+    """読んだ行 rows (time, isu) に adding を足して書き込み, コミットする batch を返す"""
+    isu = {t: int(i) for (t, i) in rows}
+    batch = dal.Batch()
+    dal.upsert_adding_rows(batch, room_name, [(t, isu.get(t, 0) + adding[t]) for t in sorted(adding)])
+    dal.update_room_time(batch, room_name, current_time)
+    batch.commit()
+    return batch
+
+
+class AddIsuBatcher:
+    """addIsu を部屋ごとに少しの間ためてから add_isu_batch でまとめて書き込む
+
+    最初の要求から delay 秒後に書き込み, コミットしてから各要求の
+    future に結果を入れる. 同じ部屋の書き込みは同時に1つしか走らせず,
+    書き込み中に来た要求は次の書き込みに回す.
+    """
+
+    def __init__(self, delay: float = 0.005):
+        self.delay = delay
+        self._pending = {}  # room_name: [(req_time, num_isu, future)]
+        self._flushing = set()  # 書き込み中の room_name
+
+    def submit(self, room_name: str, req_time: int, num_isu: int) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(room_name, [])
+        pending.append((req_time, num_isu, future))
+        if len(pending) == 1 and room_name not in self._flushing:
+            loop.call_later(self.delay, self._start_flush, room_name)
+        return future
+
+    def _start_flush(self, room_name: str):
+        if room_name in self._flushing or not self._pending.get(room_name):
+            return
+        self._flushing.add(room_name)
+        asyncio.ensure_future(self._flush(room_name))
+
+    async def _flush(self, room_name: str):
+        loop = asyncio.get_event_loop()
+        try:
+            pending = self._pending.pop(room_name, [])
+            requests = [(t, n) for t, n, _ in pending]
+            try:
+                results = await run_add_isu_batch(room_name, requests)
+            except Exception:
+                logging.exception("fail to flush add_isu: room=%s", room_name)
+                results = [False] * len(pending)
+            for (_, _, future), success in zip(pending, results):
+                if not future.done():
+                    future.set_result(success)
+        finally:
+            self._flushing.discard(room_name)
+            if self._pending.get(room_name):
+                loop.call_later(self.delay, self._start_flush, room_name)
+
+
+add_isu_batcher = AddIsuBatcher()
 
 
 def buy_item_profile(room_name: str, req_time: int, item_id: int, count_bought: int) -> bool:
     profiler = start_profile()
+    start = time.perf_counter()
     try:
         return buy_item(room_name, req_time, item_id, count_bought)
     finally:
-        end_profile(profiler)
+        end_profile(profiler, "buyItem", time.perf_counter() - start)
 
 
 def buy_item(room_name: str, req_time: int, item_id: int, count_bought: int) -> bool:
     #print(f"buy_item({room_name}, {req_time}, {item_id}, {count_bought})")
-    conn = connect_db()
+    state = get_room_state(room_name)
+    with stats.timer("buyItem", "pool"):
+        conn = db_pool.acquire()
+    session = dal.Session(conn, "buyItem")
     try:
-        update_room_time(conn, room_name, req_time)
-        cur = conn.cursor()
-
-        cur.execute("SELECT COUNT(*) FROM buying WHERE room_name = %s AND item_id = %s",
-                    (room_name, item_id))
-        count_buying, = cur.fetchone()
-        if count_bought != count_buying:
-            conn.rollback()
-            logging.warn("item is already bought: room_name=%s, item_id=%s, count_bought=%s",
-                         room_name, item_id, count_bought)
-            return False
-
-        total_milli_isu = 0
-
-        cur.execute("SELECT isu FROM adding WHERE room_name = %s AND time <= %s",
-                    (room_name, req_time))
-        for (isu,) in cur:
-            total_milli_isu += int(isu) * 1000
-
-        sql = '''
-        SELECT
-            buying.item_id AS item_id,
-            buying.ordinal AS ordinal,
-            buying.time AS time
-        FROM buying
-        WHERE buying.room_name = %s
-        '''
-        dcur = conn.cursor(MySQLdb.cursors.DictCursor)
-        dcur.execute(sql, (room_name, ))
-        buyings = dcur.fetchall()
-        # for (buy_item_id, ordinal, item_time) in buyings:
-        for buying in buyings:
-            buy_item_id = buying['item_id']
-            ordinal = buying['ordinal']
-            item_time = buying['time']
-            cost = calc_item_price(m_items[buy_item_id], ordinal)
-            total_milli_isu -= cost * 1000
-            if item_time < req_time:
-                power = calc_item_power(m_items[buy_item_id], ordinal)
-                total_milli_isu += power * (req_time - item_time)
-
-        mitem = m_items[item_id]
-        cost = calc_item_price(mitem, count_bought+1) * 1000
-        if total_milli_isu < cost:
-            conn.rollback()
-            logging.info("isu not enough")
-            return False
-
-        cur.execute("INSERT INTO buying(room_name, item_id, ordinal, time) VALUES(%s, %s, %s, %s)",
-                    (room_name, item_id, count_bought+1, req_time))
+        with session:
+            batch = dal.Batch()
+            locked = dal.lock_room(batch, room_name)
+            # メモリ上の状態がなければ, テーブルから残高を求めるための行も同じ往復で読む
+            balance = None if state.loaded else dal.select_buy_balance(batch, room_name, item_id, req_time)
+            with stats.timer("buyItem", "lock"):
+                current_time, read = run_locked(session, batch, locked, req_time)
+
+            # 部屋のロックを取っている間は他のプロセスもこの部屋に書き込めないので,
+            # 残高と購入数はメモリ上の状態から求める
+            with stats.timer("buyItem", "read"):
+                if balance is None:
+                    with state.lock:
+                        count_buying = state.item_bought[item_id]
+                        total_milli_isu = state.milli_isu_at(req_time)
+                    if total_milli_isu is None:
+                        count_buying, total_milli_isu = buy_item_balance_from_db(session, room_name, req_time, item_id)
+                else:
+                    count_buying, total_milli_isu = buy_item_balance(read, balance, req_time, item_id)
+
+            if count_bought != count_buying:
+                session.rollback()
+                logging.warning("item is already bought: room_name=%s, item_id=%s, count_bought=%s",
+                                room_name, item_id, count_bought)
+                return False
+
+            mitem = m_items[item_id]
+            cost = get_item_price(mitem, count_bought+1) * 1000
+            if total_milli_isu < cost:
+                session.rollback()
+                logging.info("isu not enough")
+                return False
+
+            batch = buy_item_write_batch(room_name, current_time, req_time, item_id, count_bought+1)
+            with state.lock:
+                with stats.timer("buyItem", "commit"):
+                    session.run(batch)
+                state.buy_item(item_id, count_bought+1, req_time)
+            return True
     except Exception as e:
-        conn.rollback()
         logging.exception("fail to buy item id=%s, bought=%d, time=%s", item_id, count_bought, req_time)
         return False
-    else:
-        conn.commit()
-        return True
     finally:
-        conn.close()
+        db_pool.release(conn, session.in_transaction)
+
+
+def buy_item_write_batch(room_name: str, current_time: int, req_time: int, item_id: int, ordinal: int) -> dal.Batch:
+    batch = dal.Batch()
+    dal.insert_buying(batch, room_name, item_id, ordinal, req_time)
+    dal.update_room_time(batch, room_name, current_time)
+    batch.commit()
+    return batch
+
+
+def buy_item_balance_from_db(session: dal.Session, room_name: str, req_time: int, item_id: int) -> (int, int):
+    """メモリ上の状態が使えないときに, テーブルから item_id の購入数と
+    時刻 req_time の椅子の数 (ミリ椅子) を求める. room_snapshot より後の行だけを読む"""
+    batch = dal.Batch()
+    balance = dal.select_buy_balance(batch, room_name, item_id, req_time)
+    return buy_item_balance(session.run(batch), balance, req_time, item_id)
+
+
+def buy_item_balance(results: list, balance: tuple, req_time: int, item_id: int) -> (int, int):
+    """dal.select_buy_balance の結果から item_id の購入数と時刻 req_time の椅子の数を求める"""
+    snapshot, count, isus, buyings = (results[i] for i in balance)
+    cp = load_snapshot(snapshot)
+    count_buying = count[0][0] + cp.item_bought.get(item_id, 0)
+    return count_buying, calc_buy_balance(req_time, [isu for (isu,) in isus], buyings, cp)
+
 
+def calc_buy_balance(req_time: int, isus: list, buyings: list, cp: Checkpoint = None) -> int:
+    """cp (req_time 以前の snapshot) に, それより後で時刻 req_time までに足された isus と,
+    cp より後のすべての (item_id, ordinal, time) を加えて時刻 req_time の椅子の数 (ミリ椅子) を求める"""
+    total_milli_isu = 0
+    if cp is not None:
+        total_milli_isu = cp.milli_isu + cp.total_power * (req_time - cp.time)
+    for isu in isus:
+        total_milli_isu += int(isu) * 1000
 
-def get_current_time(conn) -> int:
+    for (buy_item_id, ordinal, item_time) in buyings:
+        cost = get_item_price(m_items[buy_item_id], ordinal)
+        total_milli_isu -= cost * 1000
+        if item_time < req_time:
+            power = get_item_power(m_items[buy_item_id], ordinal)
+            total_milli_isu += power * (req_time - item_time)
+    return total_milli_isu
+
+
+def query_current_time(conn) -> int:
+    """MySQL の現在時刻をミリ秒で返す"""
     cur = conn.cursor()
-    cur.execute("SELECT floor(unix_timestamp(current_timestamp(3))*1000)")
+    cur.execute(dal.CURRENT_TIME_SQL)
     t, = cur.fetchone()
-    return t
+    return int(t)
+
+
+class DBClock:
+    """毎回 MySQL に現在時刻を問い合わせる時計"""
+
+    def peek(self) -> int:
+        return None
+
+    def measured(self, t: int, start: float, end: float) -> int:
+        return t
+
+    def now(self, conn, exact: bool = False) -> int:
+        return query_current_time(conn)
+
+
+class LocalClock:
+    """プロセス内の単調時計から MySQL の現在時刻を推定する時計
+
+    calibrate_interval 秒ごとに MySQL の時刻との差を測り直す. 差は
+    問い合わせが返ってきた時点で測ったことにするので, 推定値は MySQL の
+    時刻より進むことはない (遅れは往復時間以内).
+    往復に max_rtt 秒以上かかった測定は捨て, 一度も測れていなければ
+    MySQL に問い合わせた値をそのまま返す. 返す値は単調増加する.
+    """
+
+    def __init__(self, calibrate_interval: float = 5.0, max_rtt: float = 0.01):
+        self.calibrate_interval = calibrate_interval
+        self.max_rtt = max_rtt
+        self._lock = threading.Lock()
+        self._offset = None  # MySQL の時刻 - time.monotonic() (ミリ秒)
+        self._calibrated_at = 0.0
+        self._last = 0
+
+    def peek(self) -> int:
+        """MySQL に問い合わせずに推定した現在時刻. 測り直しが必要なら None"""
+        now = time.monotonic()
+        if self._offset is None or now - self._calibrated_at > self.calibrate_interval:
+            return None
+        return self._advance(int(now * 1000 + self._offset))
+
+    def measured(self, t: int, start: float, end: float) -> int:
+        """time.monotonic() が start から end の間に MySQL に問い合わせた
+        時刻 t で差を測り直し, 現在時刻を返す"""
+        if end - start <= self.max_rtt:
+            with self._lock:
+                self._offset = t - end * 1000
+                self._calibrated_at = end
+        return self._advance(t)
+
+    def calibrate(self, conn) -> int:
+        """MySQL に問い合わせて差を測り直し, 現在時刻を返す"""
+        start = time.monotonic()
+        t = query_current_time(conn)
+        return self.measured(t, start, time.monotonic())
+
+    def now(self, conn, exact: bool = False) -> int:
+        """現在時刻を返す. exact なら MySQL に問い合わせて測り直す"""
+        t = None if exact else self.peek()
+        if t is None:
+            t = self.calibrate(conn)
+        return t
+
+    def _advance(self, t: int) -> int:
+        with self._lock:
+            if t < self._last:
+                t = self._last
+            self._last = t
+        return t
+
+
+# ISU_CLOCK=db にすると毎回 MySQL に問い合わせる
+clock = DBClock() if os.environ.get("ISU_CLOCK") == "db" else LocalClock()
+
+
+# status.int2exp の時間を測る calc_status の割合
+int2exp_sample = float(os.environ.get("ISU_INT2EXP_SAMPLE", "0.01"))
+
+
+# ISU_CALC_PROCESSES を 1 以上にすると, calc_status に時間がかかる部屋は
+# プロセスプールで計算して GIL を握り続けないようにする.
+# calc_status_room で測った時間の移動平均が calc_process_threshold 秒以上の部屋が対象.
+calc_processes = int(os.environ.get("ISU_CALC_PROCESSES", "0"))
+calc_process_threshold = float(os.environ.get("ISU_CALC_PROCESS_THRESHOLD", "0.005"))
+calc_pool = None
+
+
+def start_calc_pool():
+    """calc_status 用のプロセスプールを作る
+
+    スレッドが動き出してから fork すると子プロセスでロックが
+    取られたままになることがあるので, サーバーを起動する前に呼んで
+    子プロセスを起動しておく.
+    m_items は fork した時点のものを子プロセスでも使う.
+    """
+    global calc_pool
+    if calc_processes > 0 and calc_pool is None:
+        calc_pool = concurrent.futures.ProcessPoolExecutor(calc_processes)
+        calc_pool.submit(int).result()
+
+
+def calc_status_room(state: RoomState, current_time: int, checkpoint: Checkpoint, history: RoomHistory) -> GameStatus:
+    """部屋の calc_status_history を計算する
+
+    これまでに時間がかかっていた部屋はプロセスプールに送る. 送るのは
+    checkpoint と畳み込んでいない RoomHistory の配列だけで,
+    結果も namedtuple ではなくただの tuple で受け取る.
+    """
+    # int2exp は1回ごとに測ると遅くなるので, int2exp_sample の割合の計算でだけ測る
+    timed = int2exp_sample > 0 and random.random() < int2exp_sample
+    if calc_pool is not None and state.calc_cost >= calc_process_threshold:
+        elapsed, int2exp_elapsed, packed = calc_pool.submit(
+            calc_status_packed, current_time, checkpoint, history, timed).result()
+        status = unpack_status(packed)
+    else:
+        conv = Int2ExpTimer() if timed else int2exp
+        start = time.perf_counter()
+        status = calc_status_history(current_time, m_items, checkpoint, history, conv)
+        elapsed = time.perf_counter() - start
+        int2exp_elapsed = conv.total if timed else None
+    state.calc_cost = state.calc_cost * 0.8 + elapsed * 0.2
+    stats.record("status", "calc", elapsed)
+    if int2exp_elapsed is not None:
+        stats.record("status", "int2exp", int2exp_elapsed)
+    return status
+
+
+def calc_status_packed(current_time: int, checkpoint: Checkpoint, history: RoomHistory,
+                       timed: bool = False) -> (float, float, tuple):
+    """プロセスプールの中で実行する. かかった秒数, そのうち int2exp にかかった秒数
+    (timed でなければ None) と pack_status した結果を返す"""
+    conv = Int2ExpTimer() if timed else int2exp
+    start = time.perf_counter()
+    status = calc_status_history(current_time, m_items, checkpoint, history, conv)
+    return time.perf_counter() - start, conv.total if timed else None, pack_status(status)
+
+
+def pack_status(status: GameStatus) -> tuple:
+    return (status.time,
+            [tuple(a) for a in status.adding],
+            [tuple(s) for s in status.schedule],
+            [tuple(i[:5]) + ([tuple(b) for b in i.building],) for i in status.items],
+            [tuple(o) for o in status.on_sale])
+
+
+def unpack_status(packed: tuple) -> GameStatus:
+    t, adding, schedule, items, on_sale = packed
+    return GameStatus(
+        t,
+        [Adding._make(a) for a in adding],
+        [Schedule._make(s) for s in schedule],
+        [Item(*i[:5], [Building._make(b) for b in i[5]]) for i in items],
+        [OnSale._make(o) for o in on_sale])
 
 
 def get_status_profile(room_name: str) -> dict:
     profiler = start_profile()
+    start = time.perf_counter()
     try:
         return get_status(room_name)
     finally:
-        end_profile(profiler)
+        end_profile(profiler, "status", time.perf_counter() - start)
 
 
 def get_status(room_name: str) -> dict:
-    conn = connect_db()
-    try:
-        current_time = update_room_time_shared_lock(conn, room_name)
+    """room_time には書き込まずに RoomState から status を求める
+
+    書き込み側は同じ時計で req_time が過去でないか確かめるので, ここで返した
+    time より前の add_isu, buy_item がこの後に成功することはない.
+    """
+    state = get_room_state(room_name)
+    with stats.timer("status", "clock"):
+        current_time = get_current_time_pooled()
+    status = read_status(state, current_time)
+    # calcStatusに時間がかかる可能性があるので タイムスタンプを取得し直す
+    return status._replace(time=get_current_time_pooled())
+
+
+def read_status(state: RoomState, current_time: int) -> GameStatus:
+    """DB には触らずに current_time の status を求める. time は計算した時刻になる"""
+    status = status_cache.get(state, current_time)
+    if status is not None:
+        return status
+    with stats.timer("status", "read"):
+        version, checkpoint, history = state.snapshot(current_time)
+    # 他のスレッドが先に畳み込みを進めていることがある
+    current_time = max(current_time, checkpoint.time)
+    status = calc_status_room(state, current_time, checkpoint, history)._replace(time=current_time)
+    status_cache.put(state.room_name, version, checkpoint, history, status)
+    return status
+
+
+StatusCacheEntry = namedtuple("StatusCacheEntry", ("version", "checkpoint", "history", "status"))
 
-        cur = conn.cursor()
-        cur.execute("SELECT time, isu FROM adding WHERE room_name=%s", (room_name,))
-        addings = [Adding(t, i) for (t, i) in cur]
 
-        cur.execute("SELECT item_id, ordinal, time FROM buying WHERE room_name=%s", (room_name,))
-        buyings = [Buying(i, o, t) for (i, o, t) in cur]
+class StatusCache:
+    """部屋ごとに最後に計算した status と, そのときの checkpoint, 残りのイベントを覚えておく
 
-        update_room_time_shared_lock_end(conn, room_name, current_time)
-        conn.commit()
+    RoomState の version が同じなら,
+    - 同じ時刻ならその status をそのまま返す (hit).
+    - 時刻が進んでいたら advance_status で schedule の先頭と on_sale だけ進める (advance).
+      先読みの窓に新しくイベントが入るなら進められない.
+    どちらもできなければ None を返し, 呼び出し側が計算し直す (miss).
+    max_rooms を超えたら長く使われていない部屋から捨てる.
+    """
 
-        status = calc_status(current_time, m_items, addings, buyings)
-        # calcStatusに時間がかかる可能性があるので タイムスタンプを取得し直す
-        status = status._replace(time=get_current_time(conn))
+    def __init__(self, max_rooms: int = 256):
+        self.max_rooms = max_rooms
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # room_name: StatusCacheEntry
+        self.hits = 0
+        self.advances = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, state: RoomState, current_time: int) -> GameStatus:
+        with self._lock:
+            entry = self._entries.get(state.room_name)
+            if entry is not None:
+                self._entries.move_to_end(state.room_name)
+        if entry is None or entry.version != state.version or current_time < entry.status.time:
+            self.misses += 1
+            return None
+
+        if current_time == entry.status.time:
+            self.hits += 1
+            return entry.status
+
+        status = advance_status(entry.status, m_items, entry.checkpoint, entry.history, current_time)
+        if status is None:
+            self.misses += 1
+            return None
+        self.advances += 1
+        self._put(state.room_name, entry._replace(status=status))
         return status
-    finally:
-        conn.close()
+
+    def put(self, room_name: str, version: int, checkpoint: Checkpoint, history: RoomHistory, status: GameStatus):
+        """checkpoint.time に計算した status を覚えておく"""
+        self._put(room_name, StatusCacheEntry(version, checkpoint, history, status))
+
+    def _put(self, room_name: str, entry: StatusCacheEntry):
+        with self._lock:
+            old = self._entries.get(room_name)
+            if old is not None and (old.version, old.status.time) > (entry.version, entry.status.time):
+                return
+            self._entries[room_name] = entry
+            self._entries.move_to_end(room_name)
+            while len(self._entries) > self.max_rooms:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._entries),
+            "hits": self.hits,
+            "advances": self.advances,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def status_quiet_until(status: GameStatus) -> int:
+    """status の先読みの範囲にイベントがなければ, 次に status が変わる時刻
+    (まだ売り出されていないアイテムが買えるようになる時刻) を返す.
+    イベントがあれば schedule[0].time, 操作されない限り変わらないなら None.
+    仮数と指数から戻した値を使うので目安."""
+    t = status.schedule[0].time
+    if status.adding or any(b.time > t for item in status.items for b in item.building):
+        return t
+    last = status.schedule[-1]
+    milli_isu = last.milli_isu[0] * 10 ** last.milli_isu[1]
+    power = last.total_power[0] * 10 ** last.total_power[1]
+    on_sale = {o.item_id for o in status.on_sale}
+    prices = [i.next_price[0] * 10 ** i.next_price[1] * 1000 for i in status.items if i.item_id not in on_sale]
+    if not prices or power <= 0:
+        return None
+    return last.time + max(min(prices) - milli_isu, 0) // power
+
+
+status_cache = StatusCache(max_rooms=int(os.environ.get("ISU_STATUS_CACHE_ROOMS", "256")))
+
+
+def get_current_time_pooled(exact: bool = False) -> int:
+    """時計が MySQL に問い合わせるときだけコネクションを借りる
+
+    問い合わせと COMMIT を1回の往復で送り, 返却時の rollback を省く.
+    """
+    t = None if exact else clock.peek()
+    if t is None:
+        conn = db_pool.acquire()
+        session = dal.Session(conn, "clock")
+        try:
+            with session:
+                batch, now = current_time_batch()
+                start = time.monotonic()
+                (db_time, ), = session.run(batch)[now]
+                t = clock.measured(int(db_time), start, time.monotonic())
+        finally:
+            db_pool.release(conn, session.in_transaction)
+    return t
+
+
+def current_time_batch() -> (dal.Batch, int):
+    batch = dal.Batch()
+    now = batch.add(dal.CURRENT_TIME_SQL)
+    batch.commit()
+    return batch, now
+
+
+# ISU_DB_DRIVER=async にすると get_status, add_isu_batch, buy_item を
+# スレッドプールではなく aiomysql でイベントループ上から実行する.
+# 部屋の状態の読み込みと calc_status はこれまで通り run_in_executor で行う.
+db_driver = os.environ.get("ISU_DB_DRIVER", "thread")
+
+_async_pool = None
+_async_pool_lock = None
+
+
+async def get_async_pool():
+    """aiomysql のコネクションプールを返す. 初めて呼ばれたときに作る"""
+    global _async_pool, _async_pool_lock
+    if _async_pool is None:
+        if _async_pool_lock is None:
+            _async_pool_lock = asyncio.Lock()
+        async with _async_pool_lock:
+            if _async_pool is None:
+                import aiomysql
+                # _db_info は import 時の get_m_items で作られている
+                info = dict(_db_info)
+                info["maxsize"] = db_pool.max_size
+                _async_pool = await aiomysql.create_pool(**info)
+    return _async_pool
+
+
+class locked_async:
+    """threading.Lock をイベントループを止めずに取る
+
+    すぐに取れなければワーカースレッドで取るのを待つ. RoomState.lock は
+    ワーカースレッドが load の往復の間も持っているので, ループ上で待ってはいけない.
+    """
+
+    __slots__ = ("lock", )
+
+    def __init__(self, lock: threading.Lock):
+        self.lock = lock
+
+    async def __aenter__(self):
+        if self.lock.acquire(blocking=False):
+            return
+        fut = asyncio.get_event_loop().run_in_executor(None, self.lock.acquire)
+        try:
+            await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # 待っている間にキャンセルされたら, 取れた時点で外す
+            fut.add_done_callback(lambda _: self.lock.release())
+            raise
+
+    async def __aexit__(self, *exc):
+        self.lock.release()
+
+
+async def get_room_state_async(room_name: str) -> RoomState:
+    state = _room_states.get(room_name)
+    if state is not None and state.loaded:
+        return state
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, get_room_state, room_name)
+
+
+async def run_locked_async(session: dal.Session, batch: dal.Batch, locked: int, req_time: int) -> (int, list):
+    """run_locked の aiomysql 版"""
+    start = time.monotonic()
+    results = await session.run_async(batch)
+    end = time.monotonic()
+    room_time, db_time = results[locked][0]
+    return locked_current_time(room_time, int(db_time), start, end, req_time), results
+
+
+async def get_status_async(room_name: str) -> GameStatus:
+    """get_status の aiomysql 版"""
+    loop = asyncio.get_event_loop()
+    state = await get_room_state_async(room_name)
+    with stats.timer("status", "clock"):
+        current_time = await get_current_time_pooled_async()
+    status = await loop.run_in_executor(None, read_status, state, current_time)
+    return status._replace(time=await get_current_time_pooled_async())
+
+
+async def get_current_time_pooled_async(exact: bool = False) -> int:
+    t = None if exact else clock.peek()
+    if t is None:
+        pool = await get_async_pool()
+        async with pool.acquire() as conn:
+            with dal.Session(conn, "clock") as session:
+                batch, now = current_time_batch()
+                start = time.monotonic()
+                (db_time, ), = (await session.run_async(batch))[now]
+                t = clock.measured(int(db_time), start, time.monotonic())
+    return t
+
+
+async def add_isu_batch_async(room_name: str, requests: list) -> list:
+    """add_isu_batch の aiomysql 版"""
+    state = await get_room_state_async(room_name)
+    pool = await get_async_pool()
+    async with pool.acquire() as conn:
+        with dal.Session(conn, "addIsu") as session:
+            try:
+                batch, locked, rows = add_isu_read_batch(room_name, requests)
+                with stats.timer("addIsu", "lock"):
+                    current_time, read = await run_locked_async(session, batch, locked, 0)
+
+                results, adding = merge_add_isu_requests(requests, current_time)
+                if not adding:
+                    await session.rollback_async()
+                    return results
+
+                batch = add_isu_write_batch(room_name, current_time, read[rows], adding)
+                # sync 版と同じく state.lock を持ったままコミットして反映する.
+                # 次に部屋のロックを取った要求は反映した後の状態を読む
+                async with locked_async(state.lock):
+                    with stats.timer("addIsu", "commit"):
+                        await session.run_async(batch)
+                    for t in sorted(adding):
+                        state.add_isu(t, adding[t])
+                return results
+            except Exception:
+                await conn.rollback()
+                logging.exception("fail to add isu: room=%s requests=%s", room_name, requests)
+                return [False] * len(requests)
+
+
+async def buy_item_async(room_name: str, req_time: int, item_id: int, count_bought: int) -> bool:
+    """buy_item の aiomysql 版"""
+    state = await get_room_state_async(room_name)
+    pool = await get_async_pool()
+    async with pool.acquire() as conn:
+        with dal.Session(conn, "buyItem") as session:
+            try:
+                batch = dal.Batch()
+                locked = dal.lock_room(batch, room_name)
+                balance = None if state.loaded else dal.select_buy_balance(batch, room_name, item_id, req_time)
+                with stats.timer("buyItem", "lock"):
+                    current_time, read = await run_locked_async(session, batch, locked, req_time)
+
+                with stats.timer("buyItem", "read"):
+                    if balance is None:
+                        async with locked_async(state.lock):
+                            count_buying = state.item_bought[item_id]
+                            total_milli_isu = state.milli_isu_at(req_time)
+                        if total_milli_isu is None:
+                            batch = dal.Batch()
+                            balance = dal.select_buy_balance(batch, room_name, item_id, req_time)
+                            read = await session.run_async(batch)
+                    if balance is not None:
+                        count_buying, total_milli_isu = buy_item_balance(read, balance, req_time, item_id)
+
+                if count_bought != count_buying:
+                    await session.rollback_async()
+                    logging.warning("item is already bought: room_name=%s, item_id=%s, count_bought=%s",
+                                    room_name, item_id, count_bought)
+                    return False
+
+                cost = get_item_price(m_items[item_id], count_bought+1) * 1000
+                if total_milli_isu < cost:
+                    await session.rollback_async()
+                    logging.info("isu not enough")
+                    return False
+
+                batch = buy_item_write_batch(room_name, current_time, req_time, item_id, count_bought+1)
+                async with locked_async(state.lock):
+                    with stats.timer("buyItem", "commit"):
+                        await session.run_async(batch)
+                    state.buy_item(item_id, count_bought+1, req_time)
+                return True
+            except Exception:
+                await conn.rollback()
+                logging.exception("fail to buy item id=%s, bought=%d, time=%s", item_id, count_bought, req_time)
+                return False
+
+
+async def run_get_status(room_name: str) -> GameStatus:
+    if db_driver == "async":
+        return await get_status_async(room_name)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, get_status_profile, room_name)
+
+
+async def run_add_isu_batch(room_name: str, requests: list) -> list:
+    if db_driver == "async":
+        return await add_isu_batch_async(room_name, requests)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, add_isu_batch_profile, room_name, requests)
+
+
+async def run_buy_item(room_name: str, req_time: int, item_id: int, count_bought: int) -> bool:
+    if db_driver == "async":
+        return await buy_item_async(room_name, req_time, item_id, count_bought)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, buy_item_profile, room_name, req_time, item_id, count_bought)
+
 
 import cProfile
+import random
 profile_dir = '/tmp/profile'
 
-enable_profile = False
+# ISU_PROFILE_SAMPLE の割合の要求だけ cProfile で測り, そのうち
+# ISU_PROFILE_SLOW 秒以上かかったものを profile_dir に書き出す.
+# 書き出したものは profile.sh でまとめて描画できる.
+profile_sample = float(os.environ.get("ISU_PROFILE_SAMPLE", "0"))
+profile_slow = float(os.environ.get("ISU_PROFILE_SLOW", "0.05"))
+num_slow_profiles = 0
 
 def start_profile():
-    if enable_profile:
+    if profile_sample and random.random() < profile_sample:
         profiler = cProfile.Profile()
         profiler.enable()
         return profiler
     else:
         return None
 
-def end_profile(profiler):
-    if enable_profile:
-        profiler.disable()
-        prof_filename = os.path.join(profile_dir, '%d.prof' % time.time())
+def end_profile(profiler, action: str, elapsed: float):
+    global num_slow_profiles
+    if profiler is None:
+        return
+    profiler.disable()
+    if elapsed >= profile_slow:
+        num_slow_profiles += 1
+        os.makedirs(profile_dir, exist_ok=True)
+        prof_filename = os.path.join(profile_dir, '%s-%d.prof' % (action, time.time() * 1000))
         profiler.dump_stats(prof_filename)
 
-async def serve(ws: 'aiohttp.web.WebSocketResponse', room_name: str):
-    loop = asyncio.get_event_loop()
 
-    status: dict = await loop.run_in_executor(None, get_status_profile, room_name)
-    last_status_time = time.time()
-    await ws.send_json(status, dumps=simplejson.dumps)
-
-    while not ws.closed:
-        # 0.5 秒ごとに status を送る
-        timeout = (last_status_time + 0.5) - time.time()
-        if timeout < 0:
-            status: dict = await loop.run_in_executor(None, get_status_profile, room_name)
-            last_status_time = time.time()
-            await ws.send_json(status, dumps=simplejson.dumps)
-            continue
+def get_stats() -> dict:
+    """/stats で返す集計"""
+    with _room_states_lock:
+        num_rooms = len(_room_states)
+    return {
+        "stages": stats.snapshot(),
+        "db_pool": db_pool.stats(),
+        "rooms": num_rooms,
+        "broadcasters": len(_broadcasters),
+        "push": push_totals.stats(),
+        "subscribers": sum(len(room.subscribers) for room in _broadcasters.values()),
+        "db_driver": db_driver,
+        "calc_processes": calc_processes,
+        "status_cache": status_cache.stats(),
+        "compacted": compactor.num_compacted,
+        "round_trips": dal.snapshot(),
+        "slow_profiles": num_slow_profiles,
+    }
+
+class Subscriber:
+    """1つの WebSocket への送信キュー
+
+    送信は専用のタスクで行い, 遅いクライアントが他のクライアントへの送信を
+    止めないようにする. まだ送っていない status は最新のものに置き換える.
+
+    delta が真のクライアントには, 最後に受け取ったと応答 (ackFrame) された
+    フレームからの差分を送る. keyframe_interval 回に1回はキーフレームを送る.
+    format は wire.FORMATS のどれか.
+    """
 
+    keyframe_interval = 10
+
+    def __init__(self, ws: 'aiohttp.web.WebSocketResponse', room: 'RoomBroadcaster', delta: bool = False,
+                 format: str = wire.JSON):
+        self.ws = ws
+        self.room = room
+        self.delta = delta
+        self.format = format
+        self.acked = None  # 最後に受け取ったと応答されたフレームの番号
+        self._since_keyframe = 0
+        self._queue = deque()  # None は self._status を送ることを表す
+        self._status = None
+        self._event = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def push_status(self, frame: StatusFrame):
+        if self._status is None:
+            self._queue.append(None)
+        self._status = frame
+        self._event.set()
+
+    def push(self, data: str):
+        self._queue.append(data)
+        self._event.set()
+
+    def ack(self, frame_id: int):
+        self.acked = frame_id
+
+    @property
+    def congested(self) -> bool:
+        """前に積んだ status をまだ送り始めていない (送信が詰まっている)"""
+        return self._status is not None
+
+    def close(self):
+        self._task.cancel()
+
+    def _encode(self, frame: StatusFrame) -> str:
+        if not self.delta:
+            return frame.full(self.format)
+        base = self.room.frames.get(self.acked)
+        if base is None or self._since_keyframe >= self.keyframe_interval:
+            self._since_keyframe = 0
+            return frame.keyframe(self.format)
+        self._since_keyframe += 1
+        return frame.delta(base, self.format)
+
+    async def _run(self):
         try:
-            request: dict = await ws.receive_json(timeout=timeout)
-        except asyncio.TimeoutError:
-            continue
+            while not self.ws.closed:
+                await self._event.wait()
+                self._event.clear()
+                while self._queue and not self.ws.closed:
+                    data = self._queue.popleft()
+                    if data is None:
+                        with stats.timer("status", "encode"):
+                            data = self._encode(self._status)
+                        self._status = None
+                        action = "status"
+                    else:
+                        action = "response"
+                    with stats.timer(action, "send"):
+                        await self.ws.send_str(data)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logging.exception("fail to send")
+
+
+class RoomBroadcaster:
+    """部屋ごとに status を計算し, 購読している全ソケットに送る
+
+    status は interval 秒ごとと refresh() が呼ばれたときに1回だけ計算する.
+    refresh() は coalesce 秒待ってから計算し, その間の refresh() をまとめる.
+    先読みの範囲にイベントがなく, しばらく status が変わらない部屋は
+    idle_interval 秒まで間隔を延ばす. 全員の送信が詰まっているときは
+    refresh() 以外では計算しない. 購読者がいなくなったらタスクを終了する.
+    """
+
+    interval = float(os.environ.get("ISU_STATUS_INTERVAL", "0.5"))
+    idle_interval = float(os.environ.get("ISU_STATUS_IDLE_INTERVAL", "2.0"))
+    coalesce = float(os.environ.get("ISU_STATUS_COALESCE_MS", "5")) / 1000
+    max_frames = 16  # 差分の元にするために残しておくフレームの数
+
+    def __init__(self, room_name: str):
+        self.room_name = room_name
+        self.subscribers = set()
+        self.frames = OrderedDict()  # frame_id: StatusFrame
+        self._next_frame_id = 1
+        self._wakeup = asyncio.Event()
+        self._waiters = []
+        self._task = None
+
+        self.started_at = time.monotonic()
+        self.num_frames = 0  # 計算して送った status の数
+        self.num_refreshes = 0  # refresh() の呼び出し
+        self.num_coalesced = 0  # 他の refresh() とまとめて計算を省いた数
+        self.num_skipped = 0  # 送信が詰まっていて計算しなかった回数
+        self.idle_saved = 0.0  # 間隔を延ばして省いた計算の数 (interval ごとに計算した場合との差)
+
+    def subscribe(self, ws: 'aiohttp.web.WebSocketResponse', delta: bool = False,
+                  format: str = wire.JSON) -> Subscriber:
+        sub = Subscriber(ws, self, delta, format)
+        self.subscribers.add(sub)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        sub.close()
+        self.subscribers.discard(sub)
+        if not self.subscribers:
+            self._wakeup.set()
+
+    @property
+    def next_frame_id(self) -> int:
+        """これから計算を始めるフレームの番号"""
+        return self._next_frame_id
+
+    def refresh(self) -> asyncio.Future:
+        """すぐに status を計算し直す. 計算した status を全員のキューに
+        積んだ時点で完了する future を返す"""
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        self.num_refreshes += 1
+        self._wakeup.set()
+        return waiter
+
+    def next_delay(self, status: GameStatus) -> float:
+        """status を送ってから次に計算するまでの秒数
+
+        status は schedule[0].time から 1000 ミリ秒先までを含むので,
+        それより後に変わるならその 1000 ミリ秒前までに送り直せばよい.
+        """
+        quiet_until = status_quiet_until(status)
+        if quiet_until is None:
+            delay = self.idle_interval
+        else:
+            delay = (quiet_until - 1000 - status.schedule[0].time) / 1000
+        return min(max(delay, self.interval), self.idle_interval)
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "subscribers": len(self.subscribers),
+            "frames": self.num_frames,
+            "frame_rate": self.num_frames / elapsed if elapsed > 0 else 0.0,
+            "refreshes": self.num_refreshes,
+            "coalesced": self.num_coalesced,
+            "skipped": self.num_skipped,
+            "idle_saved": self.idle_saved,
+        }
+
+    async def _run(self):
+        try:
+            delay = self.interval
+            while self.subscribers:
+                start = time.monotonic()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.idle_saved += max(time.monotonic() - start - self.interval, 0) / self.interval
+                if self._waiters and self.coalesce > 0:
+                    await asyncio.sleep(self.coalesce)
+                self._wakeup.clear()
+                if not self.subscribers:
+                    break
+
+                waiters, self._waiters = self._waiters, []
+                delay = self.interval
+                if not waiters and all(sub.congested for sub in self.subscribers):
+                    self.num_skipped += 1
+                    continue
+                self.num_coalesced += max(len(waiters) - 1, 0)
+                # 番号は計算を始めるときに振る. next_frame_id 以降のフレームは
+                # その時点までにコミットされた操作をすべて含む
+                frame_id = self._next_frame_id
+                self._next_frame_id += 1
+                try:
+                    with stats.timer("status", "total"):
+                        status = await run_get_status(self.room_name)
+                    frame = StatusFrame(frame_id, status)
+                    self.frames[frame.frame_id] = frame
+                    while len(self.frames) > self.max_frames:
+                        self.frames.popitem(last=False)
+                    for sub in self.subscribers:
+                        sub.push_status(frame)
+                    self.num_frames += 1
+                    delay = self.next_delay(status)
+                except Exception:
+                    logging.exception("fail to get status: room=%s", self.room_name)
+                for w in waiters:
+                    if not w.done():
+                        w.set_result(None)
+        finally:
+            for w in self._waiters:
+                if not w.done():
+                    w.set_result(None)
+            self._waiters = []
+            if _broadcasters.get(self.room_name) is self and not self.subscribers:
+                del _broadcasters[self.room_name]
+            push_totals.add(self)
+
+
+class PushTotals:
+    """終了した RoomBroadcaster の集計を足し合わせておく"""
+
+    def __init__(self):
+        self.clear()
+
+    def add(self, room: RoomBroadcaster):
+        s = room.stats()
+        for k in ("frames", "refreshes", "coalesced", "skipped", "idle_saved"):
+            self.totals[k] += s[k]
+
+    def clear(self):
+        self.totals = {"frames": 0, "refreshes": 0, "coalesced": 0, "skipped": 0, "idle_saved": 0.0}
+
+    def stats(self) -> dict:
+        """今動いている部屋ごとの集計と, 終了した部屋も含めた合計"""
+        rooms = {name: room.stats() for name, room in _broadcasters.items()}
+        total = dict(self.totals)
+        for s in rooms.values():
+            for k in total:
+                total[k] += s[k]
+        return {"rooms": rooms, "total": total}
+
+
+push_totals = PushTotals()
+
+
+_broadcasters = {}  # room_name: RoomBroadcaster
+
+
+def get_broadcaster(room_name: str) -> RoomBroadcaster:
+    room = _broadcasters.get(room_name)
+    if room is None:
+        room = _broadcasters[room_name] = RoomBroadcaster(room_name)
+    return room
+
+
+class RequestPipeline:
+    """1つの WebSocket から来た addIsu, buyItem を受信と切り離して実行する
+
+    受信した順に実行を始め, コミットした時点で応答を返す. status の計算し直しは
+    refresh() で頼むだけで待たない. 成功の応答には, その操作を反映した最初の
+    フレームの番号を "frame" に入れる. 続けて来た addIsu は前の addIsu の完了を
+    待たずに AddIsuBatcher に渡すので, 同じ書き込みにまとまる.
+    buyItem はそれより前の要求がすべて終わってから始め, その後の要求は
+    buyItem が終わるまで始めない. 部屋をまたいだ順序は RoomState と部屋のロックが守る.
+    """
+
+    max_pending = 64  # これより多く実行中なら受信を待たせる
 
-        #print(f"received request: {request}")
-        request_id: int = int(request["request_id"])
-        action: str = str(request["action"])
-        reqtime: int = int(request["time"])
+    def __init__(self, room_name: str, room: RoomBroadcaster, sub: Subscriber):
+        self.room_name = room_name
+        self.room = room
+        self.sub = sub
+        self._pending = set()  # 実行中の task
+        self._barrier = None  # 最後の buyItem の task
+        self._adding = []  # 最後の buyItem より後に来た addIsu の task
 
+    def submit(self, action: str, request_id: int, args: tuple):
+        """args は addIsu なら (req_time, isu), buyItem なら (req_time, item_id, count_bought)"""
         if action == "addIsu":
-            # クライアントからは isu は文字列で送られてくる
-            success = await loop.run_in_executor(None, add_isu_profile, room_name, reqtime, int(request["isu"]))
-        elif action == "buyItem":
-            # count bought はその item_id がすでに買われている数.
-            # count bought+1 個目を新たに買うことになる
-            item_id = int(request["item_id"])
-            count_bought = int(request["count_bought"])
-            success = await loop.run_in_executor(None, buy_item_profile, room_name, reqtime, item_id, count_bought)
+            task = asyncio.ensure_future(self._run(action, request_id, args, [self._barrier]))
+            self._adding.append(task)
+            task.add_done_callback(self._adding_done)
         else:
-            print(f"Invalid action: {action}")
-            await ws.close()
-            return
+            task = asyncio.ensure_future(self._run(action, request_id, args, [self._barrier] + self._adding))
+            self._barrier = task
+            self._adding = []
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def _adding_done(self, task: asyncio.Future):
+        # buyItem が来ないまま addIsu だけが続いても終わった task をため込まない
+        try:
+            self._adding.remove(task)
+        except ValueError:
+            pass
+
+    async def wait_capacity(self):
+        while len(self._pending) >= self.max_pending:
+            await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+
+    async def _run(self, action: str, request_id: int, args: tuple, after: list):
+        after = [t for t in after if t is not None and not t.done()]
+        if after:
+            await asyncio.wait(after)
+
+        start = time.perf_counter()
+        try:
+            if action == "addIsu":
+                success = await add_isu_batcher.submit(self.room_name, *args)
+            else:
+                success = await run_buy_item(self.room_name, *args)
+        except Exception:
+            logging.exception("fail to handle request: room=%s action=%s args=%s", self.room_name, action, args)
+            success = False
 
         if success:
-            status = await loop.run_in_executor(None, get_status_profile, room_name)
-            last_status_time = time.time()
-            await ws.send_json(status, dumps=simplejson.dumps)
-        #else:
-        #    print(f"fail: request={request}")
+            # 部屋の全員に新しい status を送るよう頼むが, 応答はそれを待たずに返す
+            refresh_start = time.perf_counter()
+            self.room.refresh().add_done_callback(
+                lambda _: stats.record(action, "refresh", time.perf_counter() - refresh_start))
 
-        await ws.send_json({
+        response = {
             "request_id": request_id,
             "is_success": success,
-        })
+        }
+        if success:
+            # この番号以降のフレームにこの操作が反映されている
+            response["frame"] = self.room.next_frame_id
+        self.sub.push(simplejson.dumps(response))
+        stats.record(action, "total", time.perf_counter() - start)
+
+
+async def serve(ws: 'aiohttp.web.WebSocketResponse', room_name: str, delta: bool = False,
+                format: str = wire.JSON):
+    """delta が真なら差分フレームで status を送る. format が wire.COMPACT なら
+    要素をキーを除いた配列にして送る (知らない format は JSON にする).
+    クライアントが最初に {"action": "setMode", "delta": true, "format": "compact"} を送っても良い
+
+    addIsu, buyItem は RequestPipeline で受信と並行して実行し, コミットしたら応答を返す.
+    """
+    compactor.ensure_started()
+    room = get_broadcaster(room_name)
+    sub = room.subscribe(ws, delta, format if format in wire.FORMATS else wire.JSON)
+    pipeline = RequestPipeline(room_name, room, sub)
+    try:
+        await room.refresh()
+
+        while not ws.closed:
+            msg = await ws.receive()
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            request: dict = simplejson.loads(msg.data)
+
+            #print(f"received request: {request}")
+            action: str = str(request["action"])
+            if action == "ackFrame":
+                sub.ack(int(request["frame"]))
+                continue
+            if action == "setMode":
+                sub.delta = bool(request.get("delta"))
+                format = request.get("format", sub.format)
+                sub.format = format if format in wire.FORMATS else wire.JSON
+                continue
+
+            # 形式が正しくなければここで例外にして接続を閉じる
+            request_id: int = int(request["request_id"])
+            reqtime: int = int(request["time"])
+            if action == "addIsu":
+                # クライアントからは isu は文字列で送られてくる
+                args = (reqtime, int(request["isu"]))
+            elif action == "buyItem":
+                # count bought はその item_id がすでに買われている数.
+                # count bought+1 個目を新たに買うことになる
+                args = (reqtime, int(request["item_id"]), int(request["count_bought"]))
+            else:
+                print(f"Invalid action: {action}")
+                await ws.close()
+                return
+
+            await pipeline.wait_capacity()
+            pipeline.submit(action, request_id, args)
+    finally:
+        room.unsubscribe(sub)
@@ -0,0 +1,52 @@
+"""部屋名から担当するホストを選ぶコンシステントハッシュ"""
+
+import bisect
+import hashlib
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """ホストごとに replicas 個の点をリング上に置き, キーのハッシュから
+    時計回りに最初に見つかった点のホストを返す.
+
+    ホストを追加, 削除しても, 担当が変わるのはそのホストの分のキーだけになる.
+    """
+
+    def __init__(self, hosts: list = (), replicas: int = 100):
+        self.replicas = replicas
+        self._points = []  # ハッシュ値 (昇順)
+        self._hosts = []  # self._points と同じ順のホスト
+        for host in hosts:
+            self.add(host)
+
+    def __len__(self) -> int:
+        return len(self._points) // self.replicas
+
+    @property
+    def hosts(self) -> list:
+        """登録されているホスト (名前順)"""
+        return sorted(set(self._hosts))
+
+    def add(self, host: str):
+        for i in range(self.replicas):
+            h = _hash(f"{host}#{i}")
+            k = bisect.bisect(self._points, h)
+            self._points.insert(k, h)
+            self._hosts.insert(k, host)
+
+    def remove(self, host: str):
+        points, hosts = [], []
+        for h, x in zip(self._points, self._hosts):
+            if x != host:
+                points.append(h)
+                hosts.append(x)
+        self._points, self._hosts = points, hosts
+
+    def get(self, key: str) -> str:
+        if not self._points:
+            raise KeyError("no hosts")
+        k = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._hosts[k]
@@ -0,0 +1,106 @@
+"""処理の段階ごとにかかった時間のヒストグラム
+
+record(action, stage, seconds) か timer(action, stage) で記録し,
+snapshot() で action ごと stage ごとの集計を返す.
+バケットはマイクロ秒で 2 倍ずつに区切り, 最後のバケットはそれより長いものすべて.
+"""
+
+import threading
+import time
+
+
+NUM_BUCKETS = 25  # 2^23 マイクロ秒 (約 8 秒) より長いものは最後のバケット
+
+
+class Histogram:
+
+    __slots__ = ("lock", "count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # buckets[k] は 2^(k-1) 以上 2^k 未満マイクロ秒の回数 (buckets[0] は 1 マイクロ秒未満)
+        self.buckets = [0] * NUM_BUCKETS
+
+    def record(self, seconds: float):
+        k = min(int(seconds * 1000000).bit_length(), NUM_BUCKETS - 1)
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            self.buckets[k] += 1
+
+    def percentile(self, p: float) -> float:
+        """p (0 から 1) 分位点が入っているバケットの上限を秒で返す"""
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        n = 0
+        for k, c in enumerate(self.buckets):
+            n += c
+            if n >= rank and c:
+                return min((1 << k) / 1000000, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """ミリ秒で集計する"""
+        with self.lock:
+            return {
+                "count": self.count,
+                "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+                "p50_ms": self.percentile(0.5) * 1000,
+                "p90_ms": self.percentile(0.9) * 1000,
+                "p99_ms": self.percentile(0.99) * 1000,
+                "max_ms": self.max * 1000,
+            }
+
+
+_histograms = {}  # (action, stage): Histogram
+_histograms_lock = threading.Lock()
+
+
+def get_histogram(action: str, stage: str) -> Histogram:
+    h = _histograms.get((action, stage))
+    if h is None:
+        with _histograms_lock:
+            h = _histograms.setdefault((action, stage), Histogram())
+    return h
+
+
+def record(action: str, stage: str, seconds: float):
+    get_histogram(action, stage).record(seconds)
+
+
+class timer:
+    """with の中にかかった時間を記録する. 抜けた後は elapsed で参照できる"""
+
+    __slots__ = ("histogram", "start", "elapsed")
+
+    def __init__(self, action: str, stage: str):
+        self.histogram = get_histogram(action, stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.record(self.elapsed)
+
+
+def snapshot() -> dict:
+    """{action: {stage: summary}} を返す"""
+    with _histograms_lock:
+        items = sorted(_histograms.items())
+    result = {}
+    for (action, stage), h in items:
+        result.setdefault(action, {})[stage] = h.summary()
+    return result
+
+
+def reset():
+    with _histograms_lock:
+        _histograms.clear()
@@ -0,0 +1,59 @@
+import threading
+
+import MySQLdb
+
+from fakedb import Database, make_items
+
+
+def test_rollback():
+    """rollback でトランザクション中の書き込みが消える"""
+    db = Database(make_items(2))
+    conn = db.connect()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO room_time(room_name, time) VALUES (%s, 0) ON DUPLICATE KEY UPDATE time = time", ("a",))
+    cur.execute("SELECT time FROM room_time WHERE room_name = %s FOR UPDATE", ("a",))
+    assert cur.fetchone() == (0,)
+    cur.execute("INSERT INTO buying(room_name, item_id, ordinal, time) VALUES(%s, %s, %s, %s)", ("a", 1, 1, 100))
+    conn.commit()
+
+    cur.execute("INSERT INTO adding(room_name, time, isu) VALUES (%s, %s, '0') ON DUPLICATE KEY UPDATE isu=isu",
+                ("a", 100))
+    cur.execute("INSERT INTO adding(room_name, time, isu) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE isu=VALUES(isu)",
+                ("a", 100, "5"))
+    cur.execute("SELECT isu FROM adding WHERE room_name = %s AND time <= %s", ("a", 100))
+    assert cur.fetchall() == [("5",)]
+    conn.rollback()
+
+    cur.execute("SELECT time, isu FROM adding WHERE room_name=%s", ("a",))
+    assert cur.fetchall() == []
+    cur.execute("SELECT item_id, ordinal, time FROM buying WHERE room_name=%s ORDER BY item_id, ordinal", ("a",))
+    assert cur.fetchall() == [(1, 1, 100)]
+
+    # 同じ購入は一意制約で失敗する
+    try:
+        cur.execute("INSERT INTO buying(room_name, item_id, ordinal, time) VALUES(%s, %s, %s, %s)", ("a", 1, 1, 200))
+    except MySQLdb.IntegrityError:
+        pass
+    else:
+        assert False
+
+def test_room_lock():
+    """FOR UPDATE で取った部屋のロックは commit まで他のコネクションを待たせる"""
+    db = Database(make_items(2))
+    conn1, conn2 = db.connect(), db.connect()
+    for conn in (conn1, conn2):
+        conn.cursor().execute(
+            "INSERT INTO room_time(room_name, time) VALUES (%s, 0) ON DUPLICATE KEY UPDATE time = time", ("a",))
+    conn1.cursor().execute("SELECT time FROM room_time WHERE room_name = %s FOR UPDATE", ("a",))
+
+    acquired = threading.Event()
+    def lock():
+        conn2.cursor().execute("SELECT time FROM room_time WHERE room_name = %s LOCK IN SHARE MODE", ("a",))
+        acquired.set()
+        conn2.commit()
+    th = threading.Thread(target=lock)
+    th.start()
+    assert not acquired.wait(0.05)
+    conn1.commit()
+    th.join(1)
+    assert acquired.is_set()
@@ -1,4 +1,20 @@
-from game import calc_status, calc_item_price, calc_item_power, int2exp, Schedule, Buying, Adding
+import asyncio
+import concurrent.futures
+import pickle
+import random
+import threading
+import time
+
+import MySQLdb
+import simplejson
+
+import dal
+import game
+from game import calc_status, calc_item_price, calc_item_power, int2exp, Schedule, Buying, Adding, RoomState, \
+    Checkpoint, fold_checkpoint, calc_status_checkpoint, ItemTable, get_item_price, get_item_power, \
+    ConnectionPool, LocalClock, AddIsuBatcher, RoomHistory, calc_status_history, merge_add_isu_requests, \
+    calc_buy_balance, calc_status_room, pack_status, unpack_status, read_status, StatusCache, advance_status, \
+    status_quiet_until, RoomBroadcaster, RequestPipeline
 
 def test_status_empty():
     """空の状態"""
@@ -121,6 +137,39 @@ def test_on_sale():
     assert s.items[0].count_built == 1
     assert s.items[0].next_price == (1, 0)
 
+def test_on_sale_time():
+    """先読みの途中で購入可能になる時刻"""
+
+    mitems = {
+        1: {
+        "item_id": 1,
+        "power1": 0, "power2": 3, "power3": 0, "power4": 10,  # 1000
+        "price1": 0, "price2": 2, "price3": 0, "price4": 10,  # 100
+        },
+        2: {
+        "item_id": 2,
+        "power1": 0, "power2": 0, "power3": 0, "power4": 1,  # 1
+        "price1": 0, "price2": 3, "price3": 0, "price4": 10,  # 1000
+        },
+        3: {
+        "item_id": 3,
+        "power1": 0, "power2": 0, "power3": 0, "power4": 1,  # 1
+        "price1": 0, "price2": 5, "price3": 0, "price4": 10,  # 100000
+        },
+    }
+    addings = [
+        Adding(0, "1000"),
+    ]
+    buyings = [
+        Buying(1, 1, 0),
+    ]
+
+    s = calc_status(0, mitems, addings, buyings)
+
+    # 残り 900 椅子, 生産力 1000 ミリ椅子/ミリ秒
+    assert s.schedule[0].milli_isu == (900000, 0)
+    assert s.on_sale == [(1, 0), (2, 100)]
+
 def test_status_buy():
     """アイテム購入のテスト"""
 
@@ -202,17 +251,870 @@ def test_mitem():
     assert calc_item_power(item, 1) == 81
     assert calc_item_price(item, 1) == 2048
 
+def test_item_table():
+    item = {
+        "item_id": 1,
+        "power1": 1, "power2": 2, "power3": 2, "power4": 3,
+        "price1": 5, "price2": 4, "price3": 3, "price4": 2,
+    }
+    assert get_item_power(item, 1) == 81
+    assert get_item_price(item, 1) == 2048
+    # 表はアイテムマスタに置いておき, 係数が同じなら共有する
+    assert item["_table"] is game.item_table(dict(item, _table=None))
+
+    # 上限を超えた count でも同じ値を返す
+    table = ItemTable(item, max_count=5)
+    for count in [3, 0, 8, 5, 1]:
+        assert table.get_price(count) == calc_item_price(item, count)
+        assert table.get_power(count) == calc_item_power(item, count)
+        assert table.get_price_sum(count) == sum(calc_item_price(item, n) for n in range(1, count+1))
+        assert table.get_power_sum(count) == sum(calc_item_power(item, n) for n in range(1, count+1))
+    assert len(table.price) == 6
+
 def test_conv():
     assert int2exp(int("0")) == (0, 0)
     assert int2exp(int("1234")) == (1234, 0)
     assert int2exp(int("11111111111111000000")) == (111111111111110, 5)
 
+def int2exp_str(x: int) -> (int, int):
+    """文字列変換による int2exp の元の実装"""
+    s = str(x)
+    if len(s) <= 15:
+        return (x, 0)
+    return (int(s[:15]), len(s)-15)
+
+def test_conv_property():
+    """int2exp は文字列変換による実装と同じ結果を返す"""
+    rand = random.Random(0)
+    for k in range(0, 1200):
+        for x in [10**k - 1, 10**k, 10**k + 1, 2**k - 1, 2**k, rand.randrange(10**k, 10**(k+1))]:
+            assert int2exp(x) == int2exp_str(x)
+            assert int2exp(-x) == int2exp_str(-x)
+
+def test_int2exp_timer():
+    """Int2ExpTimer を渡しても結果は変わらず, かかった時間が足される"""
+    mitems = {1: {
+        "item_id": 1,
+        "power1": 0, "power2": 1, "power3": 0, "power4": 10,
+        "price1": 0, "price2": 1, "price3": 0, "price4": 10,
+    }}
+    addings = [Adding(0, 10 ** 30), Adding(500, 1)]
+    buyings = [Buying(1, 1, 100), Buying(1, 2, 700)]
+    timer = game.Int2ExpTimer()
+    cp = Checkpoint()
+    assert calc_status_checkpoint(1000, mitems, cp, addings, buyings, timer) == \
+        calc_status_checkpoint(1000, mitems, cp, addings, buyings)
+    assert timer.total > 0
+
+def test_status_checkpoint():
+    """checkpoint に畳み込んでも calc_status と同じ結果になる"""
+    mitems = {
+        1: {
+        "item_id": 1,
+        "power1": 1, "power2": 1, "power3": 3, "power4": 2,
+        "price1": 1, "price2": 1, "price3": 7, "price4": 6,
+        },
+        2: {
+        "item_id": 2,
+        "power1": 1, "power2": 1, "power3": 7, "power4": 6,
+        "price1": 1, "price2": 1, "price3": 3, "price4": 2,
+        },
+    }
+    addings = [
+        Adding(0, "10000000"),
+        Adding(150, "1234567890123456789"),
+        Adding(2500, "3"),
+    ]
+    buyings = [
+        Buying(1, 1, 100),
+        Buying(1, 2, 200),
+        Buying(2, 1, 300),
+        Buying(2, 2, 2001),
+    ]
+
+    for current_time in [0, 100, 250, 1500, 2001, 3000]:
+        expected = calc_status(current_time, mitems, addings, buyings)
+        for t in [0, 50, 100, 200, 299, current_time]:
+            if t > current_time:
+                continue
+            cp, a, b = fold_checkpoint(Checkpoint(), mitems, addings, buyings, t)
+            assert calc_status_checkpoint(current_time, mitems, cp, a, b) == expected
+
+            # 2回に分けて畳み込んでも同じ
+            cp, a, b = fold_checkpoint(Checkpoint(), mitems, addings, buyings, t // 2)
+            cp, a, b = fold_checkpoint(cp, mitems, a, b, t)
+            assert calc_status_checkpoint(current_time, mitems, cp, a, b) == expected
+
+        # 畳み込んでいない購入が ordinal の順に並んでいなくても同じ
+        assert calc_status_checkpoint(current_time, mitems, Checkpoint(), addings, buyings[::-1]) == expected
+
+
+def test_room_history():
+    """RoomHistory から計算しても namedtuple のリストと同じ結果になる"""
+    mitems = {
+        1: {
+        "item_id": 1,
+        "power1": 1, "power2": 1, "power3": 3, "power4": 2,
+        "price1": 1, "price2": 1, "price3": 7, "price4": 6,
+        },
+    }
+    addings = [Adding(300, "5"), Adding(0, "10000000"), Adding(300, "7")]
+    buyings = [Buying(1, 1, 100), Buying(1, 2, 900), Buying(1, 3, 400)]
+
+    history = RoomHistory.from_lists(addings, buyings)
+    assert list(history.addings()) == [(0, 10000000), (300, 12)]
+    assert len(history) == 5
+
+    merged = [Adding(0, 10000000), Adding(300, 12)]
+    for current_time in [0, 200, 500]:
+        expected = calc_status(current_time, mitems, merged, buyings)
+        assert calc_status_history(current_time, mitems, Checkpoint(), history) == expected
+
+    old = history.split(400)
+    assert list(old.addings()) == [(0, 10000000), (300, 12)]
+    assert list(old.buyings()) == [(1, 1, 100), (1, 3, 400)]
+    assert list(history.addings()) == []
+    assert list(history.buyings()) == [(1, 2, 900)]
+
+def test_calc_status_room(monkeypatch):
+    """時間がかかった部屋だけプールで計算し, 結果は同じになる"""
+    mitems = {1: {
+        "item_id": 1,
+        "power1": 1, "power2": 1, "power3": 3, "power4": 2,
+        "price1": 1, "price2": 1, "price3": 7, "price4": 6,
+    }}
+    monkeypatch.setattr(game, "m_items", mitems)
+    history = RoomHistory.from_lists([Adding(0, 10000000), Adding(300, 12)],
+                                     [Buying(1, 1, 100), Buying(1, 2, 900)])
+    cp = Checkpoint(50, 1000, 0, {}, {}, {})
+    expected = calc_status_history(1000, mitems, cp, history)
+
+    # プロセス間で送るものは pickle して戻せる
+    cp2, history2 = pickle.loads(pickle.dumps((cp, history)))
+    assert calc_status_history(1000, mitems, cp2, history2) == expected
+    assert unpack_status(pickle.loads(pickle.dumps(pack_status(expected)))) == expected
+
+    submitted = []
+    class Pool(concurrent.futures.ThreadPoolExecutor):
+        def submit(self, fn, *args):
+            submitted.append(args[0])
+            return super().submit(fn, *args)
+    with Pool(1) as pool:
+        monkeypatch.setattr(game, "calc_pool", pool)
+        monkeypatch.setattr(game, "calc_process_threshold", 1.0)
+        state = RoomState("room")
+        assert calc_status_room(state, 1000, cp, history) == expected
+        assert submitted == []
+
+        state.calc_cost = 1.0
+        assert calc_status_room(state, 1000, cp, history) == expected
+        assert submitted == [1000]
+        assert state.calc_cost < 1.0
+
+def test_room_state():
+    """RoomState に反映した内容で calc_status できる"""
+    state = RoomState("room")
+    state.loaded = True
+    state.add_isu(0, 5)
+    state.add_isu(0, 5)
+    state.buy_item(1, 1, 100)
+
+    version, cp, history = state.snapshot(0)
+    assert list(history.addings()) == []
+    assert list(history.buyings()) == [Buying(1, 1, 100)]
+    assert cp.milli_isu == 10000
+
+    # ordinal が飛んでいたら読み直しが必要
+    state.buy_item(1, 3, 200)
+    assert not state.loaded
+    assert state.item_bought[1] == 1
+
+def test_read_status(monkeypatch):
+    """version が変わらない間は前回の status を使い回すか, 時刻だけ進める.
+    どちらも計算し直したものと同じになる"""
+    mitems = {1: {
+        "item_id": 1,
+        "power1": 0, "power2": 1, "power3": 0, "power4": 10,
+        "price1": 0, "price2": 1, "price3": 0, "price4": 10,
+    }}
+    monkeypatch.setattr(game, "m_items", mitems)
+    monkeypatch.setattr(game, "status_cache", StatusCache(max_rooms=1))
+    calls = []
+    def calc(state, current_time, checkpoint, history):
+        calls.append(current_time)
+        return calc_status_history(current_time, mitems, checkpoint, history)
+    monkeypatch.setattr(game, "calc_status_room", calc)
+
+    state = RoomState("room")
+    state.loaded = True
+    state.add_isu(0, 100)
+    state.add_isu(3000, 1)
+    addings = [Adding(0, 100), Adding(3000, 1)]
+
+    s1 = read_status(state, 1000)
+    assert s1.time == 1000
+    assert read_status(state, 1000) == s1
+    assert calls == [1000]
+    assert game.status_cache.hits == 1
+
+    # 時刻が進んだら schedule の先頭と on_sale だけ進める
+    for t in (1200, 1700):
+        s2 = read_status(state, t)
+        assert s2 == calc_status(t, mitems, addings, [])._replace(time=t)
+        assert s2.schedule[0].time == t
+    assert calls == [1000]
+    assert game.status_cache.advances == 2
+
+    # 先読みの窓に adding が入ったら計算し直す
+    read_status(state, 2100)
+    assert calls == [1000, 2100]
+
+    # 書き込みがあったら計算し直す
+    state.buy_item(1, 1, 2200)
+    s4 = read_status(state, 2150)
+    assert calls == [1000, 2100, 2150]
+    assert s4.items[0].count_bought == 1
+
+    # 他の部屋が入ったら追い出される
+    other = RoomState("other")
+    other.loaded = True
+    read_status(other, 2150)
+    assert game.status_cache.evictions == 1
+    read_status(state, 2160)
+    assert calls == [1000, 2100, 2150, 2150, 2160]
+
+    # 先読みの窓の外にある購入も, 時刻が進んで窓に入れば building に現れる
+    state = RoomState("b")
+    state.loaded = True
+    state.add_isu(0, 100)
+    state.buy_item(1, 1, 1200)
+    read_status(state, 0)
+    s5 = read_status(state, 300)
+    assert s5 == calc_status(300, mitems, [Adding(0, 100)], [Buying(1, 1, 1200)])._replace(time=300)
+    assert s5.items[0].building
+
+def test_advance_status():
+    """advance_status で進めた status は計算し直したものと同じ"""
+    mitems = {
+        1: {"item_id": 1, "power1": 1, "power2": 1, "power3": 3, "power4": 2,
+            "price1": 1, "price2": 1, "price3": 7, "price4": 6},
+        2: {"item_id": 2, "power1": 2, "power2": 1, "power3": 5, "power4": 3,
+            "price1": 3, "price2": 1, "price3": 2, "price4": 8},
+        3: {"item_id": 3, "power1": 1, "power2": 2, "power3": 1, "power4": 1,
+            "price1": 5, "price2": 3, "price3": 1, "price4": 4},
+    }
+    rand = random.Random(1)
+    advanced = 0
+    for _ in range(300):
+        bought = {1: 0, 2: 0, 3: 0}
+        addings = [Adding(rand.randrange(0, 4000), rand.randrange(1, 10 ** rand.randrange(1, 6)))
+                   for _ in range(rand.randrange(1, 6))]
+        buyings = []
+        for _ in range(rand.randrange(0, 6)):
+            item_id = rand.choice([1, 2, 3])
+            bought[item_id] += 1
+            buyings.append(Buying(item_id, bought[item_id], rand.randrange(0, 4000)))
+        calc_time = rand.randrange(0, 2000)
+        new_time = calc_time + rand.randrange(0, 1500)
+
+        cp, _, _ = fold_checkpoint(Checkpoint(), mitems, addings, buyings, calc_time)
+        history = RoomHistory.from_lists([a for a in addings if a.time > calc_time],
+                                         [b for b in buyings if b.time > calc_time])
+        status = calc_status_history(calc_time, mitems, cp, history)
+        result = advance_status(status._replace(time=calc_time), mitems, cp, history, new_time)
+        if result is None:
+            continue
+        advanced += 1
+        expected = calc_status_history(new_time, mitems, cp, history)
+        assert result == expected._replace(time=new_time)
+    assert advanced > 50
+
+class FakeConnection:
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+
+    def rollback(self):
+        if self.broken:
+            raise MySQLdb.OperationalError("gone away")
+
+    def ping(self):
+        self.rollback()
+
+    def close(self):
+        self.closed = True
+
+def test_connection_pool():
+    """コネクションを使い回し, 壊れたものは捨てる"""
+    pool = ConnectionPool(FakeConnection, max_size=2)
+
+    c1 = pool.acquire()
+    c2 = pool.acquire()
+    assert c1 is not c2
+
+    # 上限に達していたら返却を待つ
+    got = []
+    th = threading.Thread(target=lambda: got.append(pool.acquire()))
+    th.start()
+    th.join(0.05)
+    assert got == []
+    pool.release(c1)
+    th.join()
+    assert got == [c1]
+
+    c2.broken = True
+    pool.release(c2)
+    assert c2.closed
+    c3 = pool.acquire()
+    assert c3 is not c2
+
+    stats = pool.stats()
+    assert stats["size"] == 2
+    assert stats["created"] == 3
+    assert stats["broken"] == 1
+    assert stats["waited"] == 1
+
+class FakeClockConnection:
+    """SELECT で db_time を返すだけのコネクション"""
+    def __init__(self, db_time):
+        self.db_time = db_time
+        self.queries = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.queries += 1
+
+    def fetchone(self):
+        return (self.db_time,)
+
+def test_local_clock():
+    """測り直すまでは MySQL に問い合わせず, 時刻は戻らない"""
+    clock = LocalClock(calibrate_interval=60)
+    conn = FakeClockConnection(1000000)
+
+    t1 = clock.now(conn)
+    t2 = clock.now(conn)
+    assert conn.queries == 1
+    assert 1000000 <= t1 <= t2 < 1000000 + 1000
+
+    # MySQL の時刻が戻っても返す時刻は戻らない
+    conn.db_time = 500000
+    t3 = clock.now(conn, exact=True)
+    assert conn.queries == 2
+    assert t3 >= t2
+
+    # aiomysql の経路は peek と measured で同じ時計を使う
+    assert clock.peek() >= t3
+    clock = LocalClock(calibrate_interval=60)
+    assert clock.peek() is None
+    now = time.monotonic()
+    assert clock.measured(2000000, now, now) == 2000000
+    assert clock.peek() >= 2000000
+
+def test_merge_add_isu_requests():
+    """同じ時刻の addIsu は足し合わせ, 過去の時刻は失敗にする"""
+    results, adding = merge_add_isu_requests([(100, 1), (200, 2), (50, 3), (100, 4)], 100)
+    assert results == [True, True, False, True]
+    assert adding == {100: 5, 200: 2}
+
+def test_add_isu_batcher(monkeypatch):
+    """同じ部屋の addIsu をまとめて1回で書き込む"""
+    calls = []
+    def add_isu_batch(room_name, requests):
+        calls.append((room_name, requests))
+        return [t >= 100 for t, _ in requests]
+    monkeypatch.setattr(game, "add_isu_batch_profile", add_isu_batch)
+
+    async def run():
+        batcher = AddIsuBatcher(delay=0.01)
+        futures = [
+            batcher.submit("a", 100, 1),
+            batcher.submit("a", 100, 2),
+            batcher.submit("a", 50, 3),
+            batcher.submit("b", 200, 4),
+        ]
+        return await asyncio.gather(*futures)
+
+    results = asyncio.get_event_loop().run_until_complete(run())
+    assert results == [True, True, False, True]
+    assert sorted(calls) == [("a", [(100, 1), (100, 2), (50, 3)]), ("b", [(200, 4)])]
+
+def test_room_state_balance(monkeypatch):
+    """milli_isu_at は buy_item がテーブルから求めていた残高と同じ"""
+    mitems = {
+        1: {
+        "item_id": 1,
+        "power1": 1, "power2": 1, "power3": 3, "power4": 2,
+        "price1": 1, "price2": 1, "price3": 7, "price4": 6,
+        },
+        2: {
+        "item_id": 2,
+        "power1": 1, "power2": 1, "power3": 7, "power4": 6,
+        "price1": 1, "price2": 1, "price3": 3, "price4": 2,
+        },
+    }
+    monkeypatch.setattr(game, "m_items", mitems)
+    addings = [Adding(0, 10000000), Adding(150, 123456789), Adding(2500, 3)]
+    buyings = [Buying(1, 1, 100), Buying(1, 2, 200), Buying(2, 1, 300), Buying(2, 2, 2001)]
+
+    def balance(t):
+        milli_isu = sum(a.isu * 1000 for a in addings if a.time <= t)
+        for b in buyings:
+            m = mitems[b.item_id]
+            milli_isu -= calc_item_price(m, b.ordinal) * 1000
+            if b.time < t:
+                milli_isu += calc_item_power(m, b.ordinal) * (t - b.time)
+        return milli_isu
+
+    state = RoomState("room")
+    state.loaded = True
+    for a in addings:
+        state.add_isu(a.time, a.isu)
+    for b in buyings:
+        state.buy_item(b.item_id, b.ordinal, b.time)
+
+    state.snapshot(250)
+    assert state.milli_isu_at(100) is None
+    for t in [250, 300, 1000, 2001, 2500, 5000]:
+        assert state.milli_isu_at(t) == balance(t)
+        isus = [str(a.isu) for a in addings if a.time <= t]
+        assert calc_buy_balance(t, isus, buyings) == balance(t)
+
+def test_compact_room(monkeypatch):
+    """room_snapshot に畳み込んでも読み込んだ状態と残高は変わらない"""
+    import fakedb
+    db = fakedb.Database(fakedb.make_items(3))
+    monkeypatch.setattr(game, "db_pool", ConnectionPool(db.connect))
+    monkeypatch.setattr(game, "m_items", db.m_items)
+
+    now = int(time.time() * 1000)
+    conn = db.connect()
+    cur = conn.cursor()
+    for t, isu in [(now - 5000, 100000), (now - 3000, 7), (now + 1000, 5)]:
+        cur.execute("INSERT INTO adding(room_name, time, isu) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE isu=VALUES(isu)",
+                    ("a", t, str(isu)))
+    for item_id, ordinal, t in [(1, 1, now - 4000), (2, 1, now - 3500), (1, 2, now - 100)]:
+        cur.execute("INSERT INTO buying(room_name, item_id, ordinal, time) VALUES(%s, %s, %s, %s)",
+                    ("a", item_id, ordinal, t))
+    conn.commit()
+
+    session = dal.Session(conn, "test")
+
+    def load():
+        state = RoomState("a")
+        state.load(session)
+        _, cp, history = state.snapshot(now)
+        return calc_status_room(state, now, cp, history)
+
+    before = load()
+    balance = game.buy_item_balance_from_db(session, "a", now + 2000, 1)
+    assert game.compact_room("a", 1000)
+    assert db.room_snapshot["a"][0] <= now
+    assert load() == before
+    assert game.buy_item_balance_from_db(session, "a", now + 2000, 1) == balance
+    # 2回目は畳み込む行がない
+    assert not game.compact_room("a", 10000)
+
+def test_round_trips(monkeypatch):
+    """addIsu と buyItem はロックを取る往復と, 書き込んでコミットする往復の2回で終わる"""
+    import fakedb
+    db = fakedb.Database(fakedb.make_items(3))
+    monkeypatch.setattr(game, "db_pool", ConnectionPool(db.connect))
+    monkeypatch.setattr(game, "m_items", db.m_items)
+    monkeypatch.setattr(game, "_room_states", {})
+    clock = LocalClock()
+    monkeypatch.setattr(game, "clock", clock)
+    dal.reset()
+
+    now = int(time.time() * 1000)
+    assert game.add_isu_batch("a", [(now + 500, 1000000), (now + 500, 1), (now + 600, 2)]) == [True] * 3
+    assert game.add_isu_batch("a", [(now + 600, 3)]) == [True]
+    assert db.adding["a"] == {now + 500: "1000001", now + 600: "5"}
+    assert game.buy_item("a", now + 1000, 1, 0)
+    assert not game.buy_item("a", now + 1000, 1, 0)
+    # 推定した時計は MySQL の時刻より最大で往復時間だけ遅れる
+    assert db.room_time["a"] >= now - clock.max_rtt * 1000 - 1
+    assert not any(lock.locked() for lock in db.room_locks.values())
+
+    trips = dal.snapshot()
+    assert trips["load"] == {"count": 1, "trips": 1, "mean": 1.0, "max": 1}
+    assert trips["addIsu"]["max"] == 2
+    assert trips["buyItem"]["trips"] == 2 + 2  # 失敗した方は rollback で終わる
+
+def test_round_trips_async(monkeypatch):
+    """aiomysql 版も同じ往復で終わり, 失敗したら rollback して RoomState を変えない"""
+    import fakedb
+    db = fakedb.Database(fakedb.make_items(3))
+
+    class Cursor:
+        def __init__(self, conn):
+            self.cur = conn.conn.cursor()
+            self.fail = conn.fail
+
+        async def execute(self, sql, args=()):
+            if self.fail and self.fail in sql:
+                raise MySQLdb.OperationalError(2013, "Lost connection to MySQL server during query")
+            return self.cur.execute(sql, args)
+
+        async def fetchall(self):
+            return self.cur.fetchall()
+
+        async def nextset(self):
+            return self.cur.nextset()
+
+        async def close(self):
+            self.cur.close()
+
+    class Connection:
+        """fakedb のコネクションを aiomysql のように await で使えるようにする"""
+        fail = None  # この文字列を含むクエリを失敗させる
+
+        def __init__(self):
+            self.conn = db.connect()
+
+        async def cursor(self):
+            return Cursor(self)
+
+        async def rollback(self):
+            self.conn.rollback()
+
+    class Acquire:
+        async def __aenter__(self):
+            self.conn = pool.pop() if pool else Connection()
+            return self.conn
+
+        async def __aexit__(self, *exc):
+            # aiomysql の release と同じくここでループに戻る
+            await asyncio.sleep(0)
+            pool.append(self.conn)
+
+    class Pool:
+        def acquire(self):
+            return Acquire()
+
+    pool = []
+    monkeypatch.setattr(game, "db_pool", ConnectionPool(db.connect))
+    monkeypatch.setattr(game, "_async_pool", Pool())
+    monkeypatch.setattr(game, "m_items", db.m_items)
+    monkeypatch.setattr(game, "_room_states", {})
+    monkeypatch.setattr(game, "clock", LocalClock())
+    dal.reset()
+
+    def unlocked():
+        return not any(lock.locked() for lock in db.room_locks.values())
+
+    async def run():
+        now = int(time.time() * 1000)
+        assert await game.add_isu_batch_async("a", [(now + 500, 1000000), (now + 500, 1), (now + 600, 2)]) == [True] * 3
+        assert db.adding["a"] == {now + 500: "1000001", now + 600: "2"}
+        state = game._room_states["a"]
+        version = state.version
+
+        # 過去の時刻だけなら書き込まずに rollback する
+        assert await game.add_isu_batch_async("a", [(now - 10000, 1)]) == [False]
+        assert state.version == version and unlocked()
+
+        assert await game.buy_item_async("a", now + 1000, 1, 0)
+        assert db.buying["a"] == {(1, 1): now + 1000}
+        assert state.item_bought[1] == 1
+        # すでに買われている
+        assert not await game.buy_item_async("a", now + 1000, 1, 0)
+        assert unlocked()
+
+        # 書き込みが失敗したら rollback し, RoomState には入れない
+        version = state.version
+        pool[0].fail = "INSERT INTO buying"
+        assert not await game.buy_item_async("a", now + 1000, 1, 1)
+        pool[0].fail = "INSERT INTO adding"
+        assert await game.add_isu_batch_async("a", [(now + 700, 3)]) == [False]
+        pool[0].fail = None
+        assert db.buying["a"] == {(1, 1): now + 1000}
+        assert now + 700 not in db.adding["a"]
+        assert state.item_bought[1] == 1
+        assert state.version == version and unlocked()
+
+        # 他のスレッドが state.lock を持っている間もループは止まらず, 外れてから反映する
+        ticks = []
+
+        async def tick():
+            while len(ticks) < 5:
+                ticks.append(state.version)
+                await asyncio.sleep(0.01)
+
+        held = threading.Event()
+
+        def hold():
+            with state.lock:
+                held.set()
+                time.sleep(0.05)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        results, _ = await asyncio.gather(game.add_isu_batch_async("a", [(now + 800, 4)]), tick())
+        thread.join()
+        assert results == [True]
+        assert ticks[:3] == [version] * 3
+        assert state.version == version + 1 and unlocked()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+    trips = dal.snapshot()
+    assert trips["addIsu"]["count"] == 4
+    assert trips["addIsu"]["max"] == 2
+    assert trips["buyItem"]["trips"] == 2 + 2 + 2  # 成功, すでに買われている, 書き込みの失敗
+
+
+def test_broadcast_subscribers(monkeypatch):
+    """refresh ごとに全員に1回ずつ送り, 遅いクライアントには最新の status だけを残す"""
+    calls = []
+    next_frame_ids = []  # 計算している間の next_frame_id
+    rooms = []
+
+    async def run_get_status(room_name):
+        calls.append(room_name)
+        next_frame_ids.append(rooms[0].next_frame_id)
+        return calc_status(0, {}, [], [])._replace(time=len(calls))
+
+    class WebSocket:
+        closed = False
+
+        def __init__(self):
+            self.sent = []
+            self.blocked = asyncio.Event()
+            self.blocked.set()
+
+        async def send_str(self, data):
+            await self.blocked.wait()
+            self.sent.append(simplejson.loads(data)["time"])
+
+    monkeypatch.setattr(game, "run_get_status", run_get_status)
+    monkeypatch.setattr(game, "_broadcasters", {})
+
+    async def run():
+        room = RoomBroadcaster("a")
+        rooms.append(room)
+        room.interval = room.idle_interval = 10  # refresh したときだけ計算する
+        room.coalesce = 0
+        fast, slow, leaving = WebSocket(), WebSocket(), WebSocket()
+        slow.blocked.clear()
+        subs = [room.subscribe(ws) for ws in (fast, slow, leaving)]
+
+        for _ in range(5):
+            await room.refresh()
+            await asyncio.sleep(0)
+            # 遅いクライアントのキューは伸びない
+            assert len(subs[1]._queue) <= 1
+        assert fast.sent == leaving.sent == [1, 2, 3, 4, 5]
+        assert slow.sent == []
+
+        room.unsubscribe(subs[2])
+        await room.refresh()
+        await asyncio.sleep(0)
+        assert fast.sent == [1, 2, 3, 4, 5, 6]
+        assert leaving.sent == [1, 2, 3, 4, 5]
+
+        # 送信中だった最初の status の次は最新の status だけを送る
+        slow.blocked.set()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert slow.sent == [1, 6]
+
+        room.unsubscribe(subs[0])
+        room.unsubscribe(subs[1])
+        await asyncio.sleep(0)
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert len(calls) == 6
+    # フレームの番号は計算を始めるときに振るので, 計算中のフレームより後の番号になっている
+    assert next_frame_ids == [2, 3, 4, 5, 6, 7]
+
+
+def test_status_quiet_until():
+    """先読みの範囲にイベントがなければ, 次にアイテムが買えるようになる時刻を返す"""
+    mitems = {
+        1: {
+        "item_id": 1,
+        "power1": 0, "power2": 1, "power3": 0, "power4": 10,
+        "price1": 0, "price2": 1, "price3": 0, "price4": 10,
+        },
+        2: {
+        "item_id": 2,
+        "power1": 0, "power2": 2, "power3": 0, "power4": 10,
+        "price1": 0, "price2": 3, "price3": 0, "price4": 10,
+        },
+    }
+    addings = [Adding(0, "15")]
+    buyings = [Buying(1, 1, 100)]
+
+    # 建築中のアイテムがある
+    assert status_quiet_until(calc_status(0, mitems, addings, buyings)) == 0
+    # まだ何も建っていなければ変わらない
+    assert status_quiet_until(calc_status(0, mitems, addings, [])) is None
+
+    t = status_quiet_until(calc_status(200, mitems, addings, buyings))
+    assert t > 1200
+    assert 2 not in [o.item_id for o in calc_status(t - 1001, mitems, addings, buyings).on_sale]
+    assert game.OnSale(2, t) in calc_status(t - 1000, mitems, addings, buyings).on_sale
+
+def test_room_broadcaster(monkeypatch):
+    """同時に来た refresh は1回の計算にまとめ, 送信が詰まっていれば計算しない"""
+    mitems = {
+        1: {
+        "item_id": 1,
+        "power1": 0, "power2": 1, "power3": 0, "power4": 10,
+        "price1": 0, "price2": 1, "price3": 0, "price4": 10,
+        },
+    }
+    calls = []
+
+    async def run_get_status(room_name):
+        calls.append(room_name)
+        return calc_status(0, mitems, [], [])._replace(time=len(calls))
+
+    class WebSocket:
+        closed = False
+
+        def __init__(self):
+            self.sent = []
+            self.blocked = asyncio.Event()
+            self.blocked.set()
+
+        async def send_str(self, data):
+            await self.blocked.wait()
+            self.sent.append(data)
+
+    monkeypatch.setattr(game, "run_get_status", run_get_status)
+    monkeypatch.setattr(game, "_broadcasters", {})
+
+    async def run():
+        room = RoomBroadcaster("a")
+        room.interval = 0.01
+        room.idle_interval = 0.05
+        ws = WebSocket()
+        sub = room.subscribe(ws)
+        await asyncio.gather(room.refresh(), room.refresh(), room.refresh())
+        assert len(calls) == 1
+        assert room.num_coalesced == 2
+
+        # 変わらない部屋は idle_interval ごとにしか計算しない
+        await asyncio.sleep(0.12)
+        assert 2 <= len(calls) <= 4
+        assert room.idle_saved > 0
+
+        # 送信が詰まっている間は refresh された分だけ計算する
+        ws.blocked.clear()
+        await room.refresh()
+        await room.refresh()
+        n = len(calls)
+        await asyncio.sleep(0.12)
+        assert len(calls) == n
+        assert room.num_skipped > 0
+        ws.blocked.set()
+        await asyncio.sleep(0)
+        room.unsubscribe(sub)
+        return room.stats()
+
+    s = asyncio.get_event_loop().run_until_complete(run())
+    assert s["frames"] == len(calls)
+
+
+def test_request_pipeline(monkeypatch):
+    """addIsu は続けて実行し, buyItem は前の要求を待つ. 応答は refresh を待たない"""
+    log = []
+    gates = {}
+
+    async def submit(room_name, req_time, isu):
+        log.append(("start", req_time))
+        await gates[req_time].wait()
+        log.append(("end", req_time))
+        return True
+
+    async def run_buy_item(room_name, req_time, item_id, count_bought):
+        log.append(("start", req_time))
+        log.append(("end", req_time))
+        return item_id == 1
+
+    class Room:
+        next_frame_id = 7
+
+        def __init__(self):
+            self.waiters = []
+
+        def refresh(self):
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            return waiter
+
+    class Sub:
+        def __init__(self):
+            self.sent = []
+
+        def push(self, data):
+            self.sent.append(simplejson.loads(data))
+
+    monkeypatch.setattr(game.add_isu_batcher, "submit", submit)
+    monkeypatch.setattr(game, "run_buy_item", run_buy_item)
+
+    async def run():
+        room = Room()
+        sub = Sub()
+        pipeline = RequestPipeline("a", room, sub)
+        for t in (1, 2, 4):
+            gates[t] = asyncio.Event()
+        pipeline.submit("addIsu", 1, (1, 1))
+        pipeline.submit("addIsu", 2, (2, 1))
+        pipeline.submit("buyItem", 3, (3, 1, 0))
+        pipeline.submit("addIsu", 4, (4, 1))
+        await asyncio.sleep(0)
+        # 続けて来た addIsu は同時に実行中になる
+        assert log == [("start", 1), ("start", 2)]
+
+        gates[2].set()
+        await asyncio.sleep(0)
+        # 成功の応答には反映される最初のフレームの番号が入る
+        assert sub.sent == [{"request_id": 2, "is_success": True, "frame": 7}]
+        assert ("start", 3) not in log
+
+        gates[1].set()
+        gates[4].set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert log.index(("end", 3)) < log.index(("start", 4))
+        # refresh は完了していないが応答は返っている
+        assert [r["request_id"] for r in sub.sent] == [2, 1, 3, 4]
+        assert len(room.waiters) == 4
+        assert not any(w.done() for w in room.waiters)
+
+        await asyncio.sleep(0)
+        assert not pipeline._pending
+        # 終わった addIsu の task は残さない
+        assert not pipeline._adding
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
 if __name__ == '__main__':
     test_status_empty()
     test_status_add()
     test_status_buysingle()
     test_on_sale()
+    test_on_sale_time()
     test_status_buy()
     test_mitem()
+    test_item_table()
     test_conv()
+    test_conv_property()
+    test_int2exp_timer()
+    test_status_checkpoint()
+    test_room_history()
+    test_room_state()
+    test_connection_pool()
+    test_local_clock()
+    test_merge_add_isu_requests()
 
+    import pytest
+    with pytest.MonkeyPatch.context() as mp:
+        test_request_pipeline(mp)
@@ -0,0 +1,44 @@
+from collections import Counter
+
+from hashring import HashRing
+
+
+HOSTS = ["app0281.isu7f.k0y.org", "app0282.isu7f.k0y.org", "app0283.isu7f.k0y.org"]
+ROOMS = [f"room{i}" for i in range(3000)]
+
+
+def test_ring_balance():
+    """部屋がどのホストにもある程度均等に割り当てられる"""
+    ring = HashRing(HOSTS)
+    assert len(ring) == 3
+    assert ring.hosts == sorted(HOSTS)
+    count = Counter(ring.get(room) for room in ROOMS)
+    assert set(count) == set(HOSTS)
+    for host in HOSTS:
+        assert count[host] > len(ROOMS) / 3 * 0.7
+
+
+def test_ring_remove_add():
+    """ホストを外しても付け直しても, そのホストの部屋しか動かない"""
+    ring = HashRing(HOSTS)
+    before = {room: ring.get(room) for room in ROOMS}
+
+    ring.remove(HOSTS[0])
+    after = {room: ring.get(room) for room in ROOMS}
+    for room in ROOMS:
+        if before[room] != HOSTS[0]:
+            assert after[room] == before[room]
+        else:
+            assert after[room] != HOSTS[0]
+
+    ring.add(HOSTS[0])
+    assert {room: ring.get(room) for room in ROOMS} == before
+
+    ring.add("app0284.isu7f.k0y.org")
+    moved = [room for room in ROOMS if ring.get(room) != before[room]]
+    assert all(ring.get(room) == "app0284.isu7f.k0y.org" for room in moved)
+
+
+if __name__ == '__main__':
+    test_ring_balance()
+    test_ring_remove_add()
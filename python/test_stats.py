@@ -0,0 +1,38 @@
+import stats
+from stats import Histogram
+
+
+def test_histogram():
+    """分位点はバケットの上限で, max を超えない"""
+    h = Histogram()
+    for _ in range(90):
+        h.record(0.0001)  # 100 マイクロ秒は 64..128 のバケット
+    for _ in range(10):
+        h.record(0.01)
+
+    s = h.summary()
+    assert s["count"] == 100
+    assert s["p50_ms"] == 0.128
+    assert s["p90_ms"] == 0.128
+    assert s["p99_ms"] == 10.0
+    assert s["max_ms"] == 10.0
+    assert abs(s["mean_ms"] - (90 * 0.1 + 10 * 10) / 100) < 1e-9
+
+    # 長すぎるものは最後のバケットに入る
+    h.record(100.0)
+    assert h.buckets[-1] == 1
+
+def test_snapshot():
+    """action, stage ごとに集計し, reset で消える"""
+    stats.reset()
+    stats.record("addIsu", "lock", 0.001)
+    with stats.timer("addIsu", "commit") as t:
+        pass
+    assert t.elapsed >= 0
+    snap = stats.snapshot()
+    assert sorted(snap) == ["addIsu"]
+    assert sorted(snap["addIsu"]) == ["commit", "lock"]
+    assert snap["addIsu"]["lock"]["count"] == 1
+
+    stats.reset()
+    assert stats.snapshot() == {}
@@ -0,0 +1,139 @@
+import simplejson
+
+from game import calc_status, Adding, Buying
+from wire import encode_status, StatusFrame, COMPACT, decode_compact
+
+
+def test_encode_status():
+    """simplejson.dumps と同じ内容になる"""
+    mitems = {
+        1: {
+        "item_id": 1,
+        "power1": 1, "power2": 1, "power3": 3, "power4": 2,
+        "price1": 1, "price2": 1, "price3": 7, "price4": 6,
+        },
+        2: {
+        "item_id": 2,
+        "power1": 1, "power2": 1, "power3": 7, "power4": 6,
+        "price1": 1, "price2": 1, "price3": 3, "price4": 2,
+        },
+    }
+    addings = [
+        Adding(0, "10000000"),
+        Adding(500, "1234567890123456789"),
+    ]
+    buyings = [
+        Buying(1, 1, 100),
+        Buying(1, 2, 200),
+        Buying(2, 1, 300),
+        Buying(2, 2, 900),
+    ]
+    status = calc_status(0, mitems, addings, buyings)
+    assert simplejson.loads(encode_status(status)) == simplejson.loads(simplejson.dumps(status))
+
+    # isu は int で持っていても文字列で送る
+    status = calc_status(0, mitems, [Adding(500, 1234567890123456789)], [])
+    assert simplejson.loads(encode_status(status))["adding"] == [{"time": 500, "isu": "1234567890123456789"}]
+
+
+def apply_delta(base: dict, delta: dict) -> dict:
+    """public/game.js の applyDelta と同じ手順で差分を適用する"""
+    schedule = {s["time"]: s for s in base["schedule"]}
+    for t in delta["schedule_removed"]:
+        del schedule[t]
+    schedule.update({s["time"]: s for s in delta["schedule"]})
+
+    items = {i["item_id"]: i for i in base["items"]}
+    items.update({i["item_id"]: i for i in delta["items"]})
+
+    on_sale = {o["item_id"]: o for o in base["on_sale"]}
+    for item_id in delta["on_sale_removed"]:
+        del on_sale[item_id]
+    on_sale.update({o["item_id"]: o for o in delta["on_sale"]})
+
+    return {
+        "time": delta["time"],
+        "adding": delta["adding"],
+        "schedule": [schedule[t] for t in sorted(schedule)],
+        "items": list(items.values()),
+        "on_sale": list(on_sale.values()),
+    }
+
+
+def test_delta_frame():
+    """差分フレームを適用すると元のフレームと同じになる"""
+    mitems = {
+        1: {
+        "item_id": 1,
+        "power1": 0, "power2": 1, "power3": 0, "power4": 10,
+        "price1": 0, "price2": 1, "price3": 0, "price4": 10,
+        },
+        2: {
+        "item_id": 2,
+        "power1": 0, "power2": 2, "power3": 0, "power4": 10,
+        "price1": 0, "price2": 3, "price3": 0, "price4": 10,
+        },
+    }
+    addings = [Adding(0, "15"), Adding(1200, "1000")]
+    buyings = [Buying(1, 1, 100), Buying(1, 2, 700), Buying(2, 1, 1500)]
+
+    frames = [StatusFrame(n + 1, calc_status(t, mitems, addings, buyings))
+              for n, t in enumerate([0, 500, 1000, 1600])]
+    for base in frames:
+        for frame in frames:
+            if frame.frame_id <= base.frame_id:
+                continue
+            delta = simplejson.loads(frame.delta(base))
+            assert delta["frame"] == frame.frame_id
+            assert delta["base"] == base.frame_id
+            assert apply_delta(simplejson.loads(base.full()), delta) == simplejson.loads(frame.full())
+
+    keyframe = simplejson.loads(frames[0].keyframe())
+    assert keyframe.pop("frame") == 1
+    assert keyframe == simplejson.loads(frames[0].full())
+
+    # 変わっていない要素は送らない
+    same = StatusFrame(10, calc_status(500, mitems, addings, buyings))
+    delta = simplejson.loads(same.delta(frames[1]))
+    assert delta["items"] == []
+    assert delta["on_sale"] == []
+    assert delta["schedule_removed"] == []
+
+
+def test_compact_frame():
+    """COMPACT のフレームを decode_compact で戻すと JSON のフレームと同じになる"""
+    mitems = {
+        1: {
+        "item_id": 1,
+        "power1": 0, "power2": 1, "power3": 0, "power4": 10,
+        "price1": 0, "price2": 1, "price3": 0, "price4": 10,
+        },
+        2: {
+        "item_id": 2,
+        "power1": 0, "power2": 2, "power3": 0, "power4": 10,
+        "price1": 0, "price2": 3, "price3": 0, "price4": 10,
+        },
+    }
+    addings = [Adding(0, "15"), Adding(1200, "1234567890123456789")]
+    buyings = [Buying(1, 1, 100), Buying(1, 2, 700), Buying(2, 1, 1500)]
+
+    frames = [StatusFrame(n + 1, calc_status(t, mitems, addings, buyings))
+              for n, t in enumerate([0, 500, 1000, 1600])]
+    for frame in frames:
+        compact = frame.full(COMPACT)
+        assert decode_compact(simplejson.loads(compact)) == simplejson.loads(frame.full())
+        assert len(compact) < len(frame.full())
+        keyframe = simplejson.loads(frame.keyframe(COMPACT))
+        assert decode_compact(keyframe) == simplejson.loads(frame.keyframe())
+
+    base, frame = frames[1], frames[3]
+    delta = decode_compact(simplejson.loads(frame.delta(base, COMPACT)))
+    assert delta == simplejson.loads(frame.delta(base))
+    # format ごとに別に作る
+    assert frame.delta(base, COMPACT) != frame.delta(base)
+
+
+if __name__ == '__main__':
+    test_encode_status()
+    test_delta_frame()
+    test_compact_frame()
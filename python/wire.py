@@ -0,0 +1,181 @@
+"""status を WebSocket で送る形式にエンコードする
+
+game.py の GameStatus とその中の namedtuple だけを対象にして,
+simplejson.dumps(status) と同じ内容の JSON を直接組み立てる.
+1回のエンコード結果を部屋の全員に送り回す前提.
+
+差分モードのクライアントには StatusFrame で番号を付けたフレームを送る.
+キーフレームは通常の status に "frame" を加えたもの. 差分フレームは
+"base" のフレームから変わった schedule, items, on_sale の要素だけを持ち,
+消えた要素は *_removed に time または item_id で入る.
+
+format が COMPACT のクライアントには, 一番外側のキーはそのままで,
+adding, schedule, items, on_sale の要素をキーを除いた配列にして送る.
+[仮数, 指数] の組は平らに展開する.
+
+    adding:   [time, isu]
+    schedule: [time, milli_isu の仮数, 指数, total_power の仮数, 指数]
+    items:    [item_id, count_bought, count_built, next_price の仮数, 指数, power の仮数, 指数, [building...]]
+    building: [time, count_built, power の仮数, 指数]
+    on_sale:  [item_id, time]
+
+public/game.js の decodeCompact と decode_compact で通常の形に戻せる.
+"""
+
+JSON = "json"
+COMPACT = "compact"
+FORMATS = (JSON, COMPACT)
+
+
+def _exp(x) -> str:
+    return "[%d,%d]" % (x[0], x[1])
+
+
+def _adding(a) -> str:
+    # クライアントは isu を文字列として扱う
+    return '{"time":%d,"isu":"%s"}' % (a.time, a.isu)
+
+
+def _schedule(s) -> str:
+    return '{"time":%d,"milli_isu":%s,"total_power":%s}' % (s.time, _exp(s.milli_isu), _exp(s.total_power))
+
+
+def _building(b) -> str:
+    return '{"time":%d,"count_built":%d,"power":%s}' % (b.time, b.count_built, _exp(b.power))
+
+
+def _item(i) -> str:
+    return '{"item_id":%d,"count_bought":%d,"count_built":%d,"next_price":%s,"power":%s,"building":[%s]}' % (
+        i.item_id, i.count_bought, i.count_built, _exp(i.next_price), _exp(i.power),
+        ",".join([_building(b) for b in i.building]))
+
+
+def _on_sale(o) -> str:
+    return '{"item_id":%d,"time":%d}' % (o.item_id, o.time)
+
+
+def _compact_adding(a) -> str:
+    return '[%d,"%s"]' % (a.time, a.isu)
+
+
+def _compact_schedule(s) -> str:
+    return '[%d,%d,%d,%d,%d]' % (s.time, s.milli_isu[0], s.milli_isu[1], s.total_power[0], s.total_power[1])
+
+
+def _compact_building(b) -> str:
+    return '[%d,%d,%d,%d]' % (b.time, b.count_built, b.power[0], b.power[1])
+
+
+def _compact_item(i) -> str:
+    return '[%d,%d,%d,%d,%d,%d,%d,[%s]]' % (
+        i.item_id, i.count_bought, i.count_built, i.next_price[0], i.next_price[1], i.power[0], i.power[1],
+        ",".join([_compact_building(b) for b in i.building]))
+
+
+def _compact_on_sale(o) -> str:
+    return '[%d,%d]' % (o.item_id, o.time)
+
+
+_encoders = {
+    JSON: (_adding, _schedule, _item, _on_sale),
+    COMPACT: (_compact_adding, _compact_schedule, _compact_item, _compact_on_sale),
+}
+
+
+def encode_status(status) -> str:
+    """GameStatus を JSON 文字列にする"""
+    return '{"time":%d,"adding":[%s],"schedule":[%s],"items":[%s],"on_sale":[%s]}' % (
+        status.time,
+        ",".join([_adding(a) for a in status.adding]),
+        ",".join([_schedule(s) for s in status.schedule]),
+        ",".join([_item(i) for i in status.items]),
+        ",".join([_on_sale(o) for o in status.on_sale]),
+    )
+
+
+class _Parts:
+    """1つの format での要素ごとのエンコード結果"""
+
+    __slots__ = ("adding", "schedule", "items", "on_sale")
+
+    def __init__(self, status, fmt: str):
+        adding, schedule, item, on_sale = _encoders[fmt]
+        self.adding = ",".join([adding(a) for a in status.adding])
+        self.schedule = {s.time: schedule(s) for s in status.schedule}
+        self.items = {i.item_id: item(i) for i in status.items}
+        self.on_sale = {o.item_id: on_sale(o) for o in status.on_sale}
+
+
+class StatusFrame:
+    """番号付きの status. 要素ごとのエンコード結果を持ち, 差分を作れる
+
+    エンコードは format ごとに, その format で送る相手が現れたときに1回だけ行う.
+    """
+
+    def __init__(self, frame_id: int, status):
+        self.frame_id = frame_id
+        self.time = status.time
+        self._status = status
+        self._parts = {}  # format: _Parts
+        self._full = {}  # format: str
+        self._keyframe = {}  # format: str
+        self._deltas = {}  # (base の frame_id, format): 差分フレーム
+
+    def parts(self, fmt: str = JSON) -> _Parts:
+        p = self._parts.get(fmt)
+        if p is None:
+            p = self._parts[fmt] = _Parts(self._status, fmt)
+        return p
+
+    def full(self, fmt: str = JSON) -> str:
+        """JSON なら encode_status と同じもの"""
+        s = self._full.get(fmt)
+        if s is None:
+            p = self.parts(fmt)
+            s = self._full[fmt] = '{"time":%d,"adding":[%s],"schedule":[%s],"items":[%s],"on_sale":[%s]}' % (
+                self.time, p.adding, ",".join(p.schedule.values()),
+                ",".join(p.items.values()), ",".join(p.on_sale.values()))
+        return s
+
+    def keyframe(self, fmt: str = JSON) -> str:
+        s = self._keyframe.get(fmt)
+        if s is None:
+            s = self._keyframe[fmt] = '{"frame":%d,%s' % (self.frame_id, self.full(fmt)[1:])
+        return s
+
+    def delta(self, base: 'StatusFrame', fmt: str = JSON) -> str:
+        """base からの差分フレーム. base と format ごとに1回だけ作る"""
+        key = (base.frame_id, fmt)
+        d = self._deltas.get(key)
+        if d is not None:
+            return d
+        p, b = self.parts(fmt), base.parts(fmt)
+        d = ('{"frame":%d,"base":%d,"time":%d,"adding":[%s],'
+             '"schedule":[%s],"schedule_removed":[%s],'
+             '"items":[%s],'
+             '"on_sale":[%s],"on_sale_removed":[%s]}') % (
+            self.frame_id, base.frame_id, self.time, p.adding,
+            ",".join([v for k, v in p.schedule.items() if b.schedule.get(k) != v]),
+            ",".join(["%d" % k for k in b.schedule if k not in p.schedule]),
+            ",".join([v for k, v in p.items.items() if b.items.get(k) != v]),
+            ",".join([v for k, v in p.on_sale.items() if b.on_sale.get(k) != v]),
+            ",".join(["%d" % k for k in b.on_sale if k not in p.on_sale]),
+        )
+        self._deltas[key] = d
+        return d
+
+
+def decode_compact(data: dict) -> dict:
+    """COMPACT で受け取った status (JSON を読んだもの) を通常の形に戻す.
+    public/game.js の decodeCompact と同じ"""
+    data = dict(data)
+    data["adding"] = [{"time": a[0], "isu": a[1]} for a in data["adding"]]
+    data["schedule"] = [
+        {"time": s[0], "milli_isu": [s[1], s[2]], "total_power": [s[3], s[4]]} for s in data["schedule"]]
+    data["items"] = [
+        {"item_id": i[0], "count_bought": i[1], "count_built": i[2],
+         "next_price": [i[3], i[4]], "power": [i[5], i[6]],
+         "building": [{"time": b[0], "count_built": b[1], "power": [b[2], b[3]]} for b in i[7]]}
+        for i in data["items"]]
+    data["on_sale"] = [{"item_id": o[0], "time": o[1]} for o in data["on_sale"]]
+    return data